@@ -1,38 +1,93 @@
 import os
 import logging
-import motor.motor_asyncio
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from dotenv import load_dotenv
 import asyncio
-from datetime import datetime, timedelta
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
 from functools import wraps
+from storage import create_storage
+from retention import MAX_RETENTION_DAYS, RetentionPolicy, check_days, load_policy, save_policy
+from webhook import BOT_MODE, run_webhook
+from export import export_filename, export_tokens, parse_export_args
+from bulk_delete import (
+    ProgressMessage,
+    delete_by_filter,
+    delete_token_list,
+    format_report,
+    has_filter,
+    iter_file_tokens,
+    iter_text_tokens,
+    parse_delete_args,
+)
+from fsm_storage import MongoStorage, create_fsm_storage
+from send_scheduler import SendScheduler
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from clients import close_clients, create_bot_session, get_mongo_client
+from metrics import (
+    REGISTRY,
+    TelegramMetricsMiddleware,
+    instrument_dispatcher,
+    start_metrics_server,
+)
+from profiler import PROFILE_MAX_SECONDS, profile_process, profile_running
 
 # Загрузка переменных окружения
 load_dotenv()
 
 TOKEN = os.getenv("ADMIN_BOT_TOKEN")  # Токен бота для администратора
-MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB = os.getenv("MONGO_DB", "telegram_bot_db")
+
+# Хранилище токенов и пользователей: mongo (по умолчанию) или sqlite (один файл)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+
+# Хранилище состояний FSM: memory (по умолчанию) или mongo (общее для процессов)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "1.0"))
+
+# Политика хранения по умолчанию (те же переменные, что у пользовательского бота)
+TOKEN_TTL_DAYS = float(os.getenv("TOKEN_TTL_DAYS", "0"))
+REDEMPTION_ARCHIVE_DAYS = float(os.getenv("REDEMPTION_ARCHIVE_DAYS", "0"))
+
+# Исходящие сообщения: общий лимит в секунду и число повторов после RetryAfter
+SEND_GLOBAL_RATE = int(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Метрики: собственный HTTP-сервер (0 — не запускать) и адрес метрик
+# пользовательского бота для команды /metrics
+METRICS_HOST = os.getenv("ADMIN_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("ADMIN_METRICS_PORT", "0"))
+USER_BOT_METRICS_URL = os.getenv("USER_BOT_METRICS_URL")  # Например http://127.0.0.1:9101/metrics
+# Адрес профиля пользовательского бота для команды /profile; по умолчанию
+# тот же сервер метрик, путь /profile
+USER_BOT_PROFILE_URL = os.getenv(
+    "USER_BOT_PROFILE_URL",
+    USER_BOT_METRICS_URL.rsplit("/metrics", 1)[0] + "/profile" if USER_BOT_METRICS_URL else None,
+)
+# Секрет профиля пользовательского бота (та же переменная, что у него)
+USER_BOT_PROFILE_TOKEN = os.getenv("USER_PROFILE_TOKEN")
+PROFILE_DEFAULT_SECONDS = 10
+# Пользовательский бот работает в этом же процессе (launcher.py): его
+# метрики уже есть в общем реестре, запрос по HTTP не нужен
+USER_BOT_IN_PROCESS = False
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Асинхронное подключение к MongoDB
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
-db = client["telegram_bot_db"]
-users_collection = db["users"]
-files_collection = db["files"]
-
-# Создание бота и диспетчера
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Подключение к базе, бот и диспетчер создаются в create_clients() при
+# запуске, а не при импорте модуля
+client = db = storage = None
+bot = send_scheduler = fsm_storage = dp = None
 router = Router()
 
+# Сколько дней можно запросить в /stats
+STATS_MAX_DAYS = 90
+
 # Список ID администраторов
 ADMIN_IDS = [1758717629]  # Замените на ваши реальные ID
 
@@ -69,8 +124,96 @@ async def start(message: types.Message, **kwargs):
 @router.message(F.text == "/user_count")
 @admin_only
 async def user_count_handler(message: types.Message, **kwargs):
-    user_count = await users_collection.count_documents({})
-    await message.answer(f"Общее количество пользователей: {user_count}")
+    # Берем из счетчиков, без подсчета документов коллекции
+    totals, _ = await storage.rollups.summary(1)
+    await message.answer(f"Общее количество пользователей: {totals.get('users', 0)}")
+
+# Строка отчета по счетчикам: пользователи, загрузки по типам, активации
+def format_rollup(counters: dict) -> str:
+    uploads = {
+        name.split(".", 1)[1]: value for name, value in counters.items() if name.startswith("uploads.")
+    }
+    text = f"пользователи {counters.get('users', 0)}, загрузки {sum(uploads.values())}"
+    if uploads:
+        text += " (" + ", ".join(f"{file_type}: {count}" for file_type, count in sorted(uploads.items())) + ")"
+    return text + f", активации {counters.get('redemptions', 0)}"
+
+# Команда: Статистика за последние N дней (по умолчанию 7) из накопленных счетчиков
+@router.message(F.text.startswith("/stats"))
+@admin_only
+async def stats_handler(message: types.Message, **kwargs):
+    try:
+        parts = message.text.strip().split()
+        days = int(parts[1]) if len(parts) == 2 else 7
+        if not 1 <= days <= STATS_MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await message.answer(f"Укажите число дней от 1 до {STATS_MAX_DAYS}. Пример: /stats 7")
+        return
+
+    totals, daily = await storage.rollups.summary(days)
+    period = {}
+    for _, counters in daily:
+        for name, value in counters.items():
+            period[name] = period.get(name, 0) + value
+
+    lines = [
+        f"Всего: {format_rollup(totals)}",
+        f"За {days} дн.: {format_rollup(period)}",
+        "",
+        "По дням (UTC):",
+    ]
+    lines.extend(f"{day}: {format_rollup(counters)}" for day, counters in daily)
+    await message.answer("\n".join(lines))
+
+# Команда: Пересчитать счетчики статистики по существующим данным
+@router.message(F.text == "/rebuild_stats")
+@admin_only
+async def rebuild_stats_handler(message: types.Message, **kwargs):
+    await message.answer("Пересчитываю статистику, это может занять время...")
+    buckets = await storage.rollups.rebuild()
+    await message.answer(f"Статистика пересчитана: {buckets} корзин (итог и дни).")
+
+def format_days(days: float) -> str:
+    return f"{days:g} дн." if days > 0 else "без ограничения"
+
+# Команда: Политика хранения. Без аргументов показывает текущую,
+# "/retention ttl=30 archive=90" меняет ее (дни, 0 — без ограничения)
+@router.message(F.text.startswith("/retention"))
+@admin_only
+async def retention_handler(message: types.Message, **kwargs):
+    defaults = RetentionPolicy(TOKEN_TTL_DAYS, REDEMPTION_ARCHIVE_DAYS)
+    policy = await load_policy(storage, defaults)
+    args = message.text.strip().split()[1:]
+
+    if args:
+        try:
+            for arg in args:
+                name, _, value = arg.partition("=")
+                days = check_days(float(value))
+                if name == "ttl":
+                    policy.token_ttl_days = days
+                elif name == "archive":
+                    policy.redemption_archive_days = days
+                else:
+                    raise ValueError
+        except ValueError:
+            await message.answer(
+                f"Укажите сроки в днях, от 0 (без ограничения) до {MAX_RETENTION_DAYS}. "
+                "Пример: /retention ttl=30 archive=90"
+            )
+            return
+        await save_policy(storage, policy)
+        logger.info(f"Политика хранения изменена: {policy.to_dict()}")
+
+    text = (
+        f"Срок действия новых ключей: {format_days(policy.token_ttl_days)}\n"
+        f"Активации в архив через: {format_days(policy.redemption_archive_days)}\n\n"
+        "Срок отдельного файла задается подписью при загрузке, например ttl=7d, ttl=12h."
+    )
+    if args:
+        text = "Политика хранения сохранена. Пользовательский бот применит ее в течение минуты к новым загрузкам.\n\n" + text
+    await message.answer(text)
 
 # Команда: Показать топ популярных токенов
 @router.message(F.text.startswith("/top_tokens"))
@@ -88,17 +231,8 @@ async def top_tokens_handler(message: types.Message, **kwargs):
         )
         return
 
-    pipeline = [
-        {
-            "$project": {
-                "token": 1,
-                "usage_count": {"$size": {"$ifNull": ["$users", []]}},
-            }
-        },
-        {"$sort": {"usage_count": -1}},
-        {"$limit": top_n},
-    ]
-    top_tokens = await files_collection.aggregate(pipeline).to_list(length=top_n)
+    # Сортировка по индексу 'usage_count_index' без полного сканирования
+    top_tokens = await storage.stats.top_tokens(top_n)
 
     if not top_tokens:
         await message.answer("Нет данных о токенах.")
@@ -106,7 +240,7 @@ async def top_tokens_handler(message: types.Message, **kwargs):
 
     response = "Топ популярных токенов:\n"
     for token_info in top_tokens:
-        response += f"Токен: `{token_info['token']}`, Использований: {token_info['usage_count']}\n"
+        response += f"Токен: `{token_info['token']}`, Использований: {token_info.get('usage_count', 0)}\n"
     await message.answer(response, parse_mode="Markdown")
 
 # Команда: Показать статистику токена
@@ -120,9 +254,8 @@ async def token_stats_start(message: types.Message, state: FSMContext, **kwargs)
 @admin_only
 async def token_stats_process(message: types.Message, state: FSMContext, **kwargs):
     token = message.text.strip()
-    file_doc = await files_collection.find_one({"token": token})
-    if file_doc:
-        usage_count = len(file_doc.get("users", []))
+    usage_count = await storage.tokens.usage_count(token)
+    if usage_count is not None:
         await message.answer(
             f"Токен `{token}` был использован {usage_count} раз(а) уникальными пользователями.",
             parse_mode="Markdown",
@@ -131,71 +264,222 @@ async def token_stats_process(message: types.Message, state: FSMContext, **kwarg
         await message.answer("Токен не найден.")
     await state.clear()
 
-# Команда: Удаление токенов
-@router.message(F.text == "/delete_tokens")
+# Пакетное удаление с ходом работы в одном сообщении и итоговым отчетом
+async def run_bulk_delete(message: types.Message, delete):
+    status = await message.answer("Удаление токенов...")
+    progress = ProgressMessage(status)
+    report = await delete(lambda report: progress.update(format_report(report)))
+    logger.info(
+        f"Массовое удаление (dry_run={report.dry_run}): {report.deleted} из {report.processed}, "
+        f"пакетов {report.batches}, {report.elapsed:.1f} с"
+    )
+    await progress.update(format_report(report, finished=True), force=True)
+
+# Команда: Удаление токенов. "/delete_tokens user=123 before=2024-01-01 dry"
+# удаляет по фильтру; без фильтра бот ждет список токенов текстом или
+# файлом .txt/.csv. "dry" — только проверка, без удаления.
+@router.message(F.text.startswith("/delete_tokens"))
 @admin_only
 async def delete_tokens_start(message: types.Message, state: FSMContext, **kwargs):
-    await message.answer("Пожалуйста, отправьте токены, которые хотите удалить, разделенные пробелом.")
+    try:
+        options = parse_delete_args(message.text.split()[1:])
+    except ValueError as e:
+        await message.answer(f"{e}\nПример: /delete_tokens user=123 before=2024-01-01 dry")
+        return
+
+    if has_filter(options):
+        await run_bulk_delete(message, lambda progress: delete_by_filter(storage, options, progress))
+        return
+
+    await state.update_data(dry_run=options["dry_run"])
+    await message.answer(
+        "Пожалуйста, отправьте токены, которые хотите удалить: текстом через пробел "
+        "или файлом .txt/.csv (в CSV — столбец token или первый столбец)."
+    )
     await state.set_state(AdminDeleteTokensState.waiting_for_tokens)
 
 @router.message(AdminDeleteTokensState.waiting_for_tokens)
 @admin_only
 async def delete_tokens_process(message: types.Message, state: FSMContext, **kwargs):
-    tokens_text = message.text.strip()
-    tokens = tokens_text.split()
-    if not tokens:
+    dry_run = (await state.get_data()).get("dry_run", False)
+    await state.clear()
+
+    if message.document:
+        # Файл читается построчно, токены удаляются пакетами по мере чтения
+        data = await bot.download(message.document)
+        tokens = iter_file_tokens(data, message.document.file_name)
+    elif message.text and message.text.strip():
+        tokens = iter_text_tokens([message.text])
+    else:
         await message.answer("Вы не указали ни одного токена.")
-        await state.clear()
         return
 
-    delete_result = await files_collection.delete_many({"token": {"$in": tokens}})
-    deleted_count = delete_result.deleted_count
+    await run_bulk_delete(message, lambda progress: delete_token_list(storage, tokens, dry_run, progress))
 
-    if deleted_count > 0:
-        await message.answer(f"Успешно удалено токенов: {deleted_count}")
-    else:
-        await message.answer("Ни один из указанных токенов не был найден.")
-    await state.clear()
+# Выгрузка токенов в файл по параметрам команды
+async def send_tokens_export(message: types.Message, default_format: str):
+    try:
+        options = parse_export_args(message.text.split()[1:], default_format=default_format)
+    except ValueError as e:
+        await message.answer(
+            f"{e}\nПример: /export from=2024-01-01 to=2024-02-01 user=123 format=csv gzip"
+        )
+        return
+
+    file_content, count = await export_tokens(storage.stats, options)
+    if not count:
+        await message.answer("За указанный период не было загружено токенов.")
+        return
+
+    await bot.send_document(
+        message.chat.id,
+        BufferedInputFile(file_content, filename=export_filename(options)),
+        caption=f"Токенов: {count}",
+    )
 
 # Команда: Получить файл со всеми токенами за последние 24 часа
-@router.message(F.text == "/tokens_last24h")
+@router.message(F.text.startswith("/tokens_last24h"))
 @admin_only
 async def tokens_last24h_handler(message: types.Message, **kwargs):
-    now = datetime.utcnow()
-    last_24h = now - timedelta(hours=24)
+    await send_tokens_export(message, default_format="txt")
+
+# Команда: Выгрузка токенов за произвольный период (csv, jsonl или txt)
+@router.message(F.text.startswith("/export"))
+@admin_only
+async def export_handler(message: types.Message, **kwargs):
+    await send_tokens_export(message, default_format="csv")
 
-    tokens_cursor = files_collection.find(
-        {"uploaded_at": {"$gte": last_24h}}, {"token": 1}
+# Команда: Метрики пользовательского и админского ботов в формате Prometheus
+@router.message(F.text == "/metrics")
+@admin_only
+async def metrics_handler(message: types.Message, **kwargs):
+    sections = []
+    if USER_BOT_IN_PROCESS:
+        sections.append("# user_bot: в этом же процессе, метрики ниже\n")
+    elif USER_BOT_METRICS_URL:
+        try:
+            async with ClientSession(timeout=ClientTimeout(total=10)) as http:
+                async with http.get(USER_BOT_METRICS_URL) as response:
+                    response.raise_for_status()
+                    sections.append(f"# user_bot ({USER_BOT_METRICS_URL})\n{await response.text()}")
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при получении метрик пользовательского бота: {e}")
+            sections.append(f"# user_bot: метрики недоступны ({e})\n")
+    else:
+        sections.append("# user_bot: USER_BOT_METRICS_URL не задан\n")
+    sections.append(f"# admin_bot\n{REGISTRY.render()}")
+
+    await bot.send_document(
+        message.chat.id,
+        BufferedInputFile("\n".join(sections).encode("utf-8"), filename="metrics.txt"),
     )
-    tokens = await tokens_cursor.to_list(length=None)
-    if not tokens:
-        await message.answer("За последние 24 часа не было загружено токенов.")
+
+# Команда: Выборочный профиль пользовательского бота за N секунд
+# ("/profile 30"). Файл в формате collapsed stacks: flamegraph.pl,
+# speedscope.app или inferno-flamegraph. Стеки "cpu;..." — где работал
+# цикл событий, "idle;..." — простой цикла, "await;..." — чего ждали задачи.
+@router.message(F.text.startswith("/profile"))
+@admin_only
+async def profile_handler(message: types.Message, **kwargs):
+    args = message.text.strip().split()[1:]
+    try:
+        seconds = float(args[0]) if args else PROFILE_DEFAULT_SECONDS
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError
+    except ValueError:
+        await message.answer(f"Использование: /profile [секунды], не больше {PROFILE_MAX_SECONDS}")
         return
 
-    # Форматируем токены по 10 в строке
-    tokens_list = [token["token"] for token in tokens]
-    lines = []
-    for i in range(0, len(tokens_list), 10):
-        line = " ".join(tokens_list[i : i + 10])
-        lines.append(line)
+    if USER_BOT_IN_PROCESS:
+        if profile_running():
+            await message.answer("Профиль уже снимается, дождитесь результата.")
+            return
+        await message.answer(f"Снимаю профиль процесса ботов на {seconds:g} с...")
+        profile = await profile_process(seconds)
+    elif USER_BOT_PROFILE_URL and USER_BOT_PROFILE_TOKEN:
+        await message.answer(f"Снимаю профиль пользовательского бота на {seconds:g} с...")
+        try:
+            async with ClientSession(timeout=ClientTimeout(total=seconds + 30)) as http:
+                async with http.get(
+                    USER_BOT_PROFILE_URL,
+                    params={"seconds": f"{seconds:g}"},
+                    headers={"Authorization": f"Bearer {USER_BOT_PROFILE_TOKEN}"},
+                ) as response:
+                    if response.status != 200:
+                        await message.answer(f"Профиль не снят: {await response.text()}")
+                        return
+                    profile = await response.text()
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при получении профиля пользовательского бота: {e}")
+            await message.answer(f"Профиль недоступен: {e}")
+            return
+    else:
+        await message.answer(
+            "Профиль по HTTP не настроен: нужны USER_PROFILE_TOKEN и USER_BOT_METRICS_URL (или USER_BOT_PROFILE_URL)."
+        )
+        return
 
-    # Создаем временный файл
-    file_content = "\n".join(lines)
-    file_name = "tokens_last24h.txt"
-    with open(file_name, "w", encoding="utf-8") as f:
-        f.write(file_content)
+    stacks = len(profile.splitlines())
+    await bot.send_document(
+        message.chat.id,
+        BufferedInputFile(profile.encode("utf-8"), filename="profile.folded"),
+        caption=f"Профиль за {seconds:g} с, стеков: {stacks}",
+    )
 
-    # Отправляем файл администратору
-    await bot.send_document(message.chat.id, FSInputFile(file_name))
+# Подключение к базе, хранилище, бот и диспетчер. Клиент MongoDB и пул
+# HTTP-соединений общие для всех ботов процесса (см. clients.py).
+def create_clients():
+    global client, db, storage, bot, send_scheduler, fsm_storage, dp
 
-    # Удаляем временный файл
-    os.remove(file_name)
+    client = get_mongo_client()
+    db = client[MONGO_DB]
+    storage = create_storage(STORAGE_BACKEND, db, sqlite_path=SQLITE_PATH)
 
-# Запуск бота
-async def main():
+    bot = Bot(token=TOKEN, session=create_bot_session())
+    send_scheduler = SendScheduler(global_rate=SEND_GLOBAL_RATE, max_retries=SEND_MAX_RETRIES)
+    bot.session.middleware(send_scheduler)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    # Свое имя: в общем процессе с пользовательским ботом реестр один
+    REGISTRY.register_stats("admin_send_scheduler", send_scheduler.stats)
+    fsm_storage = create_fsm_storage(FSM_STORAGE, db, state_ttl=FSM_STATE_TTL, cache_ttl=FSM_CACHE_TTL)
+    dp = Dispatcher(storage=fsm_storage)
+
+metrics_runner = None
+
+# Запуск бота (общий для polling и webhook)
+async def on_startup():
+    global metrics_runner
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    # Индексы (или схема SQLite), на которые опираются запросы админских команд
+    await storage.prepare()
+    if isinstance(fsm_storage, MongoStorage):
+        await fsm_storage.ensure_indexes()
+
+async def on_shutdown():
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await send_scheduler.close()
+    await storage.close()
+
+def setup_dispatcher():
+    create_clients()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    instrument_dispatcher(dp, [router])
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+
+# Запуск бота в режиме polling
+async def main():
+    setup_dispatcher()
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook("admin_bot", "ADMIN_", [f"FSM_STORAGE={FSM_STORAGE}"] if FSM_STORAGE != "mongo" else [])
+    else:
+        asyncio.run(main())
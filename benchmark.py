@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from datetime import datetime
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods.base import Response
+from fake_telegram import FakeTelegram, make_document_update, make_text_update
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Офлайн-нагрузочный тест конвейера обновлений: синтетические Update
+# подаются в Dispatcher через feed_update, запросы к Bot API обрабатывает
+# FakeTelegram внутри процесса, данные лежат в отдельной базе локального
+# MongoDB (--mongo uri), в mongomock_motor (--mongo memory) или во
+# временном файле SQLite (--storage sqlite).
+#
+#   python benchmark.py --scenario redeem_storm --updates 5000 --concurrency 200
+#   python benchmark.py --scenario top_tokens --docs 1000000
+#   python benchmark.py --storage sqlite --updates 1000
+
+SCENARIOS = ("redeem_storm", "uploaders", "top_tokens")
+
+# Последний middleware сессии: вместо HTTP-запроса отвечает FakeTelegram,
+# поэтому планировщик отправки и метрики остаются в цепочке
+class FakeApiMiddleware(BaseRequestMiddleware):
+    def __init__(self, fake: FakeTelegram, latency: float = 0.0):
+        self.fake = fake
+        self.latency = latency
+        self.count = 0
+
+    async def __call__(self, make_request, bot, method):
+        self.count += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = method.model_dump(mode="json", exclude_none=True, exclude_defaults=True)
+        if "media" in params:
+            params["media"] = json.dumps(params["media"])
+        result = self.fake.handle_method(method.__api_method__, params)
+        response = Response[method.__returning__].model_validate(
+            {"ok": True, "result": result}, context={"bot": bot}
+        )
+        return response.result
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# Импорт ботов с тестовыми настройками; переменные окружения читаются
+# модулями ботов при импорте, поэтому задаются заранее
+def load_bots(args):
+    os.environ["MONGO_DB"] = args.db
+    os.environ["STORAGE_BACKEND"] = args.storage
+    if args.storage == "sqlite":
+        args.sqlite_dir = tempfile.mkdtemp(prefix="benchmark-")
+        os.environ["SQLITE_PATH"] = os.path.join(args.sqlite_dir, f"{args.db}.sqlite")
+    os.environ.setdefault("USER_BOT_TOKEN", "1:benchmark")
+    os.environ.setdefault("ADMIN_BOT_TOKEN", "2:benchmark")
+    os.environ.setdefault("CHANNEL_ID", "@benchmark")
+    if args.mongo == "memory":
+        try:
+            import mongomock_motor
+        except ImportError:
+            sys.exit("Для --mongo memory нужен пакет mongomock-motor")
+        import motor.motor_asyncio
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    else:
+        os.environ["MONGO_URI"] = args.mongo
+
+    import admin_bot
+    import user_bot
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    fake = FakeTelegram()
+    fake.calls = deque(maxlen=1000)
+    api = FakeApiMiddleware(fake, latency=args.api_latency / 1000)
+    for module in (user_bot, admin_bot):
+        module.setup_dispatcher()
+        module.bot.session.middleware(api)
+        if not args.send_limits:
+            # Лимиты Telegram на отправку не должны ограничивать пропускную
+            # способность: все ответы админского сценария идут в один чат
+            scheduler = module.send_scheduler
+            scheduler.global_policy = TokenBucket(10**9, 1)
+            scheduler.private_chat_policy = scheduler.group_chat_policy = TokenBucket(10**9, 1)
+    return user_bot, admin_bot, api
+
+# Подача обновлений с ограничением числа одновременно обрабатываемых
+async def feed_updates(module, updates, concurrency: int):
+    from aiogram.types import Update
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def feed(raw):
+        update = Update.model_validate(raw, context={"bot": module.bot})
+        async with semaphore:
+            started = time.perf_counter()
+            await module.dp.feed_update(module.bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(raw) for raw in updates))
+    return latencies, time.perf_counter() - started
+
+# Много пользователей активируют один популярный ключ
+async def scenario_redeem_storm(user_bot, admin_bot, args):
+    token, _ = await user_bot.storage.tokens.save_file(
+        user_bot.generate_token(), 1, "hot-file", "hot-file-unique", "document"
+    )
+    updates = [make_text_update(100000 + i, token, update_id=i + 1) for i in range(args.updates)]
+    return user_bot, updates
+
+# Много разных пользователей загружают разные файлы
+async def scenario_uploaders(user_bot, admin_bot, args):
+    updates = [
+        make_document_update(200000 + i, f"file-{i}", f"unique-{i}", update_id=i + 1)
+        for i in range(args.updates)
+    ]
+    return user_bot, updates
+
+# /top_tokens по большой коллекции файлов
+async def scenario_top_tokens(user_bot, admin_bot, args):
+    batch = []
+    now = datetime.utcnow()
+    for i in range(args.docs):
+        batch.append({
+            "user_id": i % 1000,
+            "file_id": f"seed-{i}",
+            "file_unique_id": f"seed-unique-{i}",
+            "file_type": "document",
+            "token": f"seed-token-{i}",
+            "uploaded_at": now,
+            "usage_count": (i * 7919) % 100000,
+        })
+        if len(batch) == 10000:
+            await user_bot.storage.tokens.insert_files(batch)
+            batch = []
+    if batch:
+        await user_bot.storage.tokens.insert_files(batch)
+    admin_id = admin_bot.ADMIN_IDS[0]
+    updates = [make_text_update(admin_id, "/top_tokens 10", update_id=i + 1) for i in range(args.updates)]
+    return admin_bot, updates
+
+async def run(args):
+    user_bot, admin_bot, api = load_bots(args)
+    if args.mongo == "memory" and args.storage == "mongo":
+        # mongomock не поддерживает capped-коллекции и collMod, поэтому
+        # полный on_startup не запускается: нужна только очередь активаций
+        user_bot.redemption_writer.start()
+    else:
+        await user_bot.dp.emit_startup(bot=user_bot.bot)
+        await admin_bot.dp.emit_startup(bot=admin_bot.bot)
+    try:
+        for name in args.scenario:
+            user_bot.token_cache.clear()
+
+            setup_started = time.perf_counter()
+            module, updates = await globals()[f"scenario_{name}"](user_bot, admin_bot, args)
+            setup_seconds = time.perf_counter() - setup_started
+
+            calls_before = api.count
+            latencies, elapsed = await feed_updates(module, updates, args.concurrency)
+            print(
+                f"{name}: {len(latencies)} обновлений за {elapsed:.2f} с "
+                f"({len(latencies) / elapsed:.0f} upd/s), "
+                f"p50 {percentile(latencies, 50) * 1000:.1f} мс, "
+                f"p99 {percentile(latencies, 99) * 1000:.1f} мс, "
+                f"вызовов API {api.count - calls_before}, подготовка {setup_seconds:.2f} с"
+            )
+    finally:
+        await user_bot.dp.emit_shutdown(bot=user_bot.bot)
+        await admin_bot.dp.emit_shutdown(bot=admin_bot.bot)
+        if args.keep_db:
+            if args.storage == "sqlite":
+                print(f"База SQLite сохранена: {os.environ['SQLITE_PATH']}")
+        elif args.storage == "sqlite":
+            shutil.rmtree(args.sqlite_dir, ignore_errors=True)
+        else:
+            await user_bot.client.drop_database(args.db)
+        await user_bot.close_clients()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработки обновлений")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--mongo", default="mongodb://127.0.0.1:27017", help="URI MongoDB или memory")
+    parser.add_argument("--storage", choices=("mongo", "sqlite"), default="mongo", help="Хранилище токенов")
+    parser.add_argument("--db", default="telegram_bot_benchmark", help="База для теста (удаляется после)")
+    parser.add_argument("--updates", type=int, default=2000, help="Обновлений в сценарии")
+    parser.add_argument("--concurrency", type=int, default=100, help="Одновременно обрабатываемых обновлений")
+    parser.add_argument("--docs", type=int, default=100000, help="Документов для top_tokens")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Задержка ответа Bot API, мс")
+    parser.add_argument("--send-limits", action="store_true", help="Соблюдать лимиты отправки Telegram")
+    parser.add_argument("--keep-db", action="store_true", help="Не удалять тестовую базу")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.db == "telegram_bot_db":
+        sys.exit("Тест удаляет свою базу; рабочую базу telegram_bot_db указывать нельзя")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
@@ -0,0 +1,168 @@
+import asyncio
+import csv
+import io
+import logging
+import re
+import time
+from aiogram.exceptions import TelegramAPIError
+from export import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# Массовое удаление токенов админом: список из сообщения или файла
+# .txt/.csv либо фильтр по пользователю и дате загрузки. Токены читаются
+# потоком и удаляются пакетами по DELETE_BATCH_SIZE, чтобы один запрос
+# не держал блокировки на тысячах документов.
+
+DELETE_BATCH_SIZE = 500
+# Пауза между пакетами, чтобы не занимать базу целиком
+DELETE_BATCH_PAUSE = 0.05
+# Не чаще одного редактирования сообщения о ходе удаления за столько секунд
+PROGRESS_INTERVAL = 2.0
+
+TOKEN_SEPARATORS = re.compile(r"[\s,;]+")
+
+# Параметры из текста команды: user=123 before=2024-01-01 dry.
+# Возвращает {"user_id", "before", "dry_run"}; без фильтров user_id и before — None.
+def parse_delete_args(args) -> dict:
+    options = {"user_id": None, "before": None, "dry_run": False}
+    for arg in args:
+        if arg == "dry":
+            options["dry_run"] = True
+            continue
+        name, sep, value = arg.partition("=")
+        if not sep:
+            raise ValueError(f"Непонятный параметр: {arg}")
+        if name == "user":
+            options["user_id"] = int(value)
+        elif name == "before":
+            options["before"] = parse_datetime(value)
+        else:
+            raise ValueError(f"Неизвестный параметр: {name}")
+    return options
+
+def has_filter(options: dict) -> bool:
+    return options["user_id"] is not None or options["before"] is not None
+
+# Токены из текста: разделители — пробелы, переводы строк, запятые, ';'
+def iter_text_tokens(lines):
+    for line in lines:
+        for token in TOKEN_SEPARATORS.split(line):
+            if token:
+                yield token
+
+# Токены из CSV: столбец token, если он есть в заголовке, иначе первый столбец
+def iter_csv_tokens(lines):
+    reader = csv.reader(lines)
+    column = 0
+    for number, row in enumerate(reader):
+        if not row:
+            continue
+        if number == 0 and "token" in row:
+            column = row.index("token")
+            continue
+        if column < len(row) and row[column].strip():
+            yield row[column].strip()
+
+# Построчное чтение загруженного файла
+def iter_file_tokens(data: io.BytesIO, filename: str):
+    lines = io.TextIOWrapper(data, encoding="utf-8-sig", errors="replace", newline="")
+    if (filename or "").lower().endswith(".csv"):
+        return iter_csv_tokens(lines)
+    return iter_text_tokens(lines)
+
+def _batches(tokens, size: int):
+    batch = []
+    for token in tokens:
+        batch.append(token)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Итоги удаления; progress(report) вызывается после каждого пакета
+class DeleteReport:
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        self.processed = 0  # токенов прочитано из списка или найдено фильтром
+        self.deleted = 0  # удалено (при dry_run — было бы удалено)
+        self.batches = 0
+        self.started = time.monotonic()
+
+    @property
+    def not_found(self) -> int:
+        return self.processed - self.deleted
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+# Удаление пакета токенов; при dry_run только подсчет существующих
+async def _delete_batch(storage, tokens, report: DeleteReport):
+    tokens = list(dict.fromkeys(tokens))
+    report.processed += len(tokens)
+    report.batches += 1
+    if report.dry_run:
+        report.deleted += len(await storage.tokens.existing(tokens))
+        return
+    deleted = await storage.tokens.delete(tokens)
+    if deleted:
+        report.deleted += deleted
+        # Пользовательский бот сбросит эти токены из своего кэша
+        await storage.tokens.publish_invalidation(tokens)
+
+# Удаление токенов из списка (генератора строк файла или сообщения)
+async def delete_token_list(storage, tokens, dry_run: bool = False, progress=None, batch_size: int = DELETE_BATCH_SIZE):
+    report = DeleteReport(dry_run)
+    for batch in _batches(tokens, batch_size):
+        await _delete_batch(storage, batch, report)
+        if progress is not None:
+            await progress(report)
+        await asyncio.sleep(DELETE_BATCH_PAUSE)
+    return report
+
+# Удаление токенов, подходящих под фильтр (пользователь и/или дата загрузки)
+async def delete_by_filter(storage, options: dict, progress=None, batch_size: int = DELETE_BATCH_SIZE):
+    report = DeleteReport(options["dry_run"])
+    async for batch in storage.tokens.iter_tokens(options["user_id"], options["before"], batch_size):
+        await _delete_batch(storage, batch, report)
+        if progress is not None:
+            await progress(report)
+        await asyncio.sleep(DELETE_BATCH_PAUSE)
+    return report
+
+def format_report(report: DeleteReport, finished: bool = False) -> str:
+    if report.dry_run:
+        text = f"Проверка без удаления: найдено {report.deleted} из {report.processed} токенов"
+    else:
+        text = f"Удалено {report.deleted} из {report.processed} токенов"
+    text += f", пакетов {report.batches}, {report.elapsed:.1f} с"
+    if not finished:
+        return text + "..."
+    text += "."
+    if report.not_found:
+        text += f"\nНе найдено: {report.not_found}"
+    if report.dry_run:
+        text += "\nЧтобы удалить, повторите команду без dry."
+    return text
+
+# Обновление одного сообщения о ходе удаления не чаще PROGRESS_INTERVAL
+class ProgressMessage:
+    def __init__(self, message, interval: float = PROGRESS_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._last_edit = time.monotonic()
+        self._last_text = message.text
+
+    async def update(self, text: str, force: bool = False):
+        now = time.monotonic()
+        if text == self._last_text or (not force and now - self._last_edit < self.interval):
+            return
+        self._last_edit = now
+        self._last_text = text
+        try:
+            await self.message.edit_text(text)
+        except TelegramAPIError as e:
+            # Отчет о ходе не должен прерывать удаление
+            logger.warning(f"Не удалось обновить сообщение о ходе удаления: {e}")
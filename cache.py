@@ -0,0 +1,117 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# Маркер отсутствия значения (None тоже может быть закэширован)
+_MISSING = object()
+
+
+# Отменяется ли сама текущая задача (Task.cancelling появился в Python 3.11)
+def _is_cancelling() -> bool:
+    task = asyncio.current_task()
+    cancelling = getattr(task, "cancelling", None)
+    return bool(cancelling and cancelling())
+
+
+# LRU-кэш с ограничением размера и временем жизни записей.
+# Параллельные загрузки одного и того же ключа схлопываются в один запрос.
+class TTLCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # ключ -> (значение, момент истечения)
+        self._inflight = {}  # ключ -> asyncio.Future текущей загрузки
+
+        # Счетчики для настройки размеров и TTL
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    # Возвращает значение из кэша или вызывает loader() ровно один раз
+    # на все одновременные запросы одного ключа.
+    # ttl_for(value) позволяет задать разное время жизни для разных значений.
+    # Если запрос, который загружал значение, отменен, отмена не передается
+    # ожидающим: загрузку заново начинает один из них.
+    async def get_or_load(self, key, loader, ttl_for=None):
+        while True:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled() or _is_cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, не даем asyncio ругаться
+            future.exception()
+            raise
+        else:
+            self.set(key, value, ttl_for(value) if ttl_for else None)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,86 @@
+import os
+import motor.motor_asyncio
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from dotenv import load_dotenv
+from metrics import MongoMetricsListener
+
+# Общие клиенты процесса: одно подключение к MongoDB и один пул HTTP-соединений
+# к Bot API на все боты процесса (user_bot, admin_bot или оба в launcher.py).
+# Создаются при первом обращении, а не при импорте модулей.
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Другой адрес Bot API, например fake_telegram.py
+
+# Пул соединений MongoDB и таймауты (миллисекунды; 0 — значение драйвера).
+# Сжатие: список через запятую из zstd, snappy, zlib (zlib есть всегда,
+# zstd и snappy требуют пакетов zstandard и python-snappy).
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zlib")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0"))
+
+# Максимум одновременных HTTP-соединений к Bot API на процесс
+BOT_API_CONNECTIONS = int(os.getenv("BOT_API_CONNECTIONS", "100"))
+
+_mongo_client = None
+_http_session = None
+
+def mongo_client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS or None,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS or None,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS or None,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS or None,
+        "appname": "telegram-bot",
+    }
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return {name: value for name, value in options.items() if value is not None}
+
+# Клиент Motor на весь процесс
+def get_mongo_client():
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = motor.motor_asyncio.AsyncIOMotorClient(
+            MONGO_URI, event_listeners=[MongoMetricsListener()], **mongo_client_options()
+        )
+    return _mongo_client
+
+# Сессия Bot API, у которой своя цепочка middleware (планировщик отправки
+# конкретного бота), а соединения берутся из общего пула процесса.
+# Закрытие сессии бота пул не закрывает: это делает close_clients().
+class SharedAiohttpSession(AiohttpSession):
+    async def create_session(self):
+        return await _get_http_session().create_session()
+
+    async def close(self):
+        pass
+
+def _get_http_session() -> AiohttpSession:
+    global _http_session
+    if _http_session is None:
+        _http_session = AiohttpSession(limit=BOT_API_CONNECTIONS)
+    return _http_session
+
+def create_bot_session() -> SharedAiohttpSession:
+    if TELEGRAM_API_URL:
+        return SharedAiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    return SharedAiohttpSession()
+
+# Закрытие общих клиентов после остановки всех ботов процесса
+async def close_clients():
+    global _mongo_client, _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+    if _mongo_client is not None:
+        _mongo_client.close()
+        _mongo_client = None
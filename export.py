@@ -0,0 +1,114 @@
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+# Выгрузка токенов: курсор читается пакетами и сразу пишется в буфер
+# (при необходимости сжатый gzip), весь список в памяти не собирается.
+
+EXPORT_FORMATS = ("txt", "csv", "jsonl")
+EXPORT_FIELDS = ("token", "user_id", "file_type", "usage_count", "uploaded_at")
+EXPORT_BATCH_SIZE = 1000
+
+# Дата из аргумента команды. Даты в базе хранятся в UTC без часового
+# пояса, поэтому дата с поясом (2024-01-01T00:00+03:00) переводится в UTC.
+def parse_datetime(value: str) -> datetime:
+    result = datetime.fromisoformat(value)
+    if result.tzinfo is not None:
+        result = result.astimezone(timezone.utc).replace(tzinfo=None)
+    return result
+
+# Параметры выгрузки из аргументов команды:
+# from=2024-01-01 to=2024-01-31T12:00 user=123 format=csv gzip
+def parse_export_args(args, default_period=timedelta(hours=24), default_format="txt") -> dict:
+    now = datetime.utcnow()
+    options = {"start": now - default_period, "end": now, "user_id": None, "format": default_format, "gzip": False}
+
+    for arg in args:
+        if arg == "gzip":
+            options["gzip"] = True
+            continue
+        name, sep, value = arg.partition("=")
+        if not sep:
+            raise ValueError(f"Непонятный параметр: {arg}")
+        if name == "from":
+            options["start"] = parse_datetime(value)
+        elif name == "to":
+            options["end"] = parse_datetime(value)
+        elif name == "user":
+            options["user_id"] = int(value)
+        elif name == "format":
+            if value not in EXPORT_FORMATS:
+                raise ValueError(f"Формат должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+            options["format"] = value
+        else:
+            raise ValueError(f"Неизвестный параметр: {name}")
+
+    if options["start"] >= options["end"]:
+        raise ValueError("Начало периода должно быть раньше конца.")
+    return options
+
+def export_query(options: dict) -> dict:
+    query = {"uploaded_at": {"$gte": options["start"], "$lt": options["end"]}}
+    if options["user_id"] is not None:
+        query["user_id"] = options["user_id"]
+    return query
+
+def export_filename(options: dict) -> str:
+    name = f"tokens_{options['start']:%Y%m%d%H%M}_{options['end']:%Y%m%d%H%M}"
+    if options["user_id"] is not None:
+        name += f"_user{options['user_id']}"
+    name += f".{options['format']}"
+    if options["gzip"]:
+        name += ".gz"
+    return name
+
+def _row(doc: dict) -> dict:
+    uploaded_at = doc.get("uploaded_at")
+    return {
+        "token": doc.get("token"),
+        "user_id": doc.get("user_id"),
+        "file_type": doc.get("file_type"),
+        "usage_count": doc.get("usage_count", 0),
+        "uploaded_at": uploaded_at.isoformat() if uploaded_at else None,
+    }
+
+# Запись выгрузки в буфер; возвращает (содержимое, количество токенов)
+async def write_export(cursor, fmt: str, compress: bool = False):
+    raw = io.BytesIO()
+    stream = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        async for doc in cursor:
+            writer.writerow(_row(doc))
+            count += 1
+    elif fmt == "jsonl":
+        async for doc in cursor:
+            text.write(json.dumps(_row(doc), ensure_ascii=False) + "\n")
+            count += 1
+    else:
+        # Прежний формат: токены по 10 в строке
+        line = []
+        async for doc in cursor:
+            line.append(doc["token"])
+            count += 1
+            if len(line) == 10:
+                text.write(" ".join(line) + "\n")
+                line = []
+        if line:
+            text.write(" ".join(line))
+
+    text.flush()
+    text.detach()
+    if compress:
+        stream.close()
+    return raw.getvalue(), count
+
+# Выгрузка токенов через запросы статистики хранилища (storage.stats)
+async def export_tokens(stats, options: dict):
+    return await write_export(stats.export_rows(options), options["format"], options["gzip"])
@@ -0,0 +1,132 @@
+import argparse
+import itertools
+import json
+import logging
+import time
+from aiohttp import ClientSession, web
+
+logger = logging.getLogger(__name__)
+
+# Локальная замена Telegram Bot API для офлайн-проверки режима webhook.
+# Бот направляется сюда через TELEGRAM_API_URL=http://127.0.0.1:8081,
+# а обновления отправляются в webhook бота через POST /fake/updates.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+class FakeTelegram:
+    def __init__(self, subscribed: bool = True):
+        self.subscribed = subscribed
+        self.calls = []  # (метод, параметры) всех вызовов API
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+    def _message(self, chat_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    # Ответ на вызов метода Bot API
+    def handle_method(self, method: str, params: dict):
+        self.calls.append((method, params))
+        method = method.lower()
+        chat_id = params.get("chat_id", 0)
+
+        if method == "getme":
+            return BOT_USER
+        if method == "setwebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            return True
+        if method == "deletewebhook":
+            self.webhook_url = None
+            return True
+        if method == "getchatmember":
+            status = "member" if self.subscribed else "left"
+            return {"status": status, "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "User"}}
+        if method == "getfile":
+            file_id = params.get("file_id")
+            return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_path": f"files/{file_id}"}
+        if method == "sendmediagroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self._message(chat_id) for _ in media]
+        if method == "sendmessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(chat_id)
+        return True
+
+    # Отправка обновления в webhook бота (как это делает Telegram)
+    async def push_update(self, update: dict):
+        if not self.webhook_url:
+            raise RuntimeError("Webhook не установлен")
+        update.setdefault("update_id", next(self._update_ids))
+        headers = {}
+        if self.webhook_secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+        async with ClientSession() as session:
+            async with session.post(self.webhook_url, json=update, headers=headers) as response:
+                return response.status
+
+# Построение обновления с текстовым сообщением от пользователя
+def make_text_update(user_id: int, text: str, update_id: int = None):
+    update = {
+        "message": {
+            "message_id": int(time.time() * 1000) % 1_000_000_000,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+        }
+    }
+    if update_id is not None:
+        update["update_id"] = update_id
+    return update
+
+# Построение обновления с документом от пользователя
+def make_document_update(user_id: int, file_id: str, file_unique_id: str, update_id: int = None):
+    update = make_text_update(user_id, "", update_id)
+    del update["message"]["text"]
+    update["message"]["document"] = {"file_id": file_id, "file_unique_id": file_unique_id}
+    return update
+
+async def _read_params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    form = await request.post()
+    return {key: value for key, value in form.items() if isinstance(value, str)}
+
+def build_fake_app(fake: FakeTelegram) -> web.Application:
+    async def api_method(request: web.Request):
+        params = await _read_params(request)
+        result = fake.handle_method(request.match_info["method"], params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def push_update(request: web.Request):
+        status = await fake.push_update(await request.json())
+        return web.json_response({"ok": True, "webhook_status": status})
+
+    async def list_calls(request: web.Request):
+        return web.json_response([{"method": method, "params": params} for method, params in fake.calls])
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api_method)
+    app.router.add_post("/fake/updates", push_update)
+    app.router.add_get("/fake/calls", list_calls)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--not-subscribed", action="store_true", help="getChatMember вернет status=left")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(build_fake_app(FakeTelegram(subscribed=not args.not_subscribed)), host=args.host, port=args.port)
@@ -0,0 +1,83 @@
+import copy
+from datetime import datetime
+from pymongo import ReturnDocument
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from cache import TTLCache
+from indexes import IndexSpec, ensure_indexes
+
+# Хранилище FSM в MongoDB: состояния переживают перезапуск и доступны
+# всем процессам. Один документ на ключ: {_id, state, data, updated_at}.
+# Документы, не менявшиеся state_ttl секунд, удаляет TTL-индекс.
+# Локальный кэш чтения держится cache_ttl секунд (0 — без кэша), поэтому
+# при нескольких воркерах его стоит оставлять коротким. Запись меняет
+# только свое поле, а в кэш кладется документ, который вернула база,
+# так что устаревший кэш не затирает поле, измененное другим воркером.
+class MongoStorage(BaseStorage):
+    def __init__(self, collection, state_ttl: int = 86400, cache_ttl: float = 1.0, cache_size: int = 10000):
+        self.collection = collection
+        self.state_ttl = state_ttl
+        self.cache_ttl = cache_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    async def ensure_indexes(self):
+        await ensure_indexes(
+            self.collection,
+            [IndexSpec("updated_at", "fsm_updated_at_ttl_index", expireAfterSeconds=self.state_ttl)],
+        )
+
+    async def _load(self, key_id: str) -> dict:
+        if self.cache_ttl > 0:
+            doc = self._cache.get(key_id)
+            if doc is not None:
+                return doc
+        doc = await self.collection.find_one({"_id": key_id}, {"state": 1, "data": 1}) or {}
+        record = {"state": doc.get("state"), "data": doc.get("data") or {}}
+        if self.cache_ttl > 0:
+            self._cache.set(key_id, record)
+        return record
+
+    async def _save(self, key_id: str, field: str, value):
+        # Пустое значение не создает документ, если его еще нет
+        doc = await self.collection.find_one_and_update(
+            {"_id": key_id},
+            {"$set": {field: value, "updated_at": datetime.utcnow()}},
+            projection={"state": 1, "data": 1},
+            upsert=bool(value),
+            return_document=ReturnDocument.AFTER,
+        ) or {}
+        record = {"state": doc.get("state"), "data": doc.get("data") or {}}
+        if doc and record["state"] is None and not record["data"]:
+            # Удаляется, только если другой воркер не успел его заполнить
+            await self.collection.delete_one({"_id": key_id, "state": None, "data": {"$in": [None, {}]}})
+        if self.cache_ttl > 0:
+            self._cache.set(key_id, record)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self._save(self.key_builder.build(key), "state", state)
+
+    async def get_state(self, key):
+        record = await self._load(self.key_builder.build(key))
+        return record["state"]
+
+    async def set_data(self, key, data):
+        await self._save(self.key_builder.build(key), "data", dict(data))
+
+    async def get_data(self, key):
+        record = await self._load(self.key_builder.build(key))
+        return copy.deepcopy(record["data"])
+
+    async def close(self):
+        # Клиент MongoDB закрывается владельцем
+        self._cache.clear()
+
+# Выбор хранилища FSM по значению переменной окружения FSM_STORAGE
+def create_fsm_storage(kind: str, db, state_ttl: int = 86400, cache_ttl: float = 1.0):
+    if kind == "mongo":
+        return MongoStorage(db["fsm_states"], state_ttl=state_ttl, cache_ttl=cache_ttl)
+    if kind != "memory":
+        raise ValueError(f"Неизвестное хранилище FSM: {kind!r}")
+    return MemoryStorage()
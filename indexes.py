@@ -0,0 +1,128 @@
+import logging
+import time
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Описание индекса: ключи в формате pymongo и параметры create_index
+class IndexSpec:
+    def __init__(self, keys, name: str, **options):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        self.keys = [(field, direction) for field, direction in keys]
+        self.name = name
+        self.options = options
+
+# Параметры, которые влияют на поведение индекса и сравниваются с существующим
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+def _key_pattern(keys):
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys]
+
+def _options(source: dict) -> dict:
+    # Сравнение через is: expireAfterSeconds=0 не должен считаться отсутствующим
+    options = {
+        name: source[name] for name in COMPARED_OPTIONS
+        if source.get(name) is not None and source.get(name) is not False
+    }
+    if "expireAfterSeconds" in options:
+        options["expireAfterSeconds"] = int(options["expireAfterSeconds"])
+    return options
+
+# Через сколько после expires_at документ удаляет TTL-индекс. Больше
+# интервала фоновой очистки, чтобы она успевала удалить ключ первой.
+EXPIRED_FILES_GRACE_SECONDS = 7 * 24 * 3600
+
+# Индексы всех коллекций, которыми пользуются боты
+FILES_INDEXES = [
+    IndexSpec("token", "token_index", unique=True),
+    # Составной индекс: выборка ключей пользователя и листание по _id
+    IndexSpec([("user_id", 1), ("_id", 1)], "files_user_id_index"),
+    IndexSpec("uploaded_at", "uploaded_at_index"),
+    IndexSpec([("usage_count", -1)], "usage_count_index"),
+    # Истекшие ключи удаляет фоновая очистка (retention.run_compaction)
+    # вместе с активациями; TTL-индекс — страховка, если очистка не работает
+    IndexSpec("expires_at", "files_expires_at_ttl_index", expireAfterSeconds=EXPIRED_FILES_GRACE_SECONDS),
+    # Один документ на файл Telegram; у старых документов поля нет
+    IndexSpec(
+        "file_unique_id",
+        "file_unique_id_index",
+        unique=True,
+        partialFilterExpression={"file_unique_id": {"$exists": True}},
+    ),
+]
+USERS_INDEXES = [
+    IndexSpec("user_id", "user_id_index", unique=True),
+]
+REDEMPTIONS_INDEXES = [
+    IndexSpec([("token", 1), ("user_id", 1)], "token_user_id_index", unique=True),
+    # Выборка старых активаций для переноса в архив
+    IndexSpec("redeemed_at", "redeemed_at_index"),
+]
+# Архив тоже хранит одну запись на пару: по нему проверяются повторные активации
+REDEMPTIONS_ARCHIVE_INDEXES = [
+    IndexSpec([("token", 1), ("user_id", 1)], "token_user_id_index", unique=True),
+]
+
+# Приведение индексов коллекции к описанию: создается только недостающее,
+# изменившийся TTL меняется через collMod без перестройки, остальные
+# расхождения пересоздают один конкретный индекс.
+async def ensure_indexes(collection, specs) -> dict:
+    started = time.perf_counter()
+    summary = {"created": [], "modified": [], "unchanged": [], "failed": []}
+    existing = await collection.index_information()
+
+    for spec in specs:
+        wanted_keys = _key_pattern(spec.keys)
+        wanted_options = _options(spec.options)
+
+        # Ищем индекс с тем же именем, а если его нет — с теми же ключами
+        current_name = spec.name if spec.name in existing else None
+        if current_name is None:
+            for name, info in existing.items():
+                if _key_pattern(info["key"]) == wanted_keys:
+                    current_name = name
+                    break
+
+        try:
+            if current_name is not None:
+                info = existing[current_name]
+                current_options = _options(info)
+                if _key_pattern(info["key"]) == wanted_keys and current_options == wanted_options:
+                    summary["unchanged"].append(current_name)
+                    continue
+
+                ttl_only = (
+                    _key_pattern(info["key"]) == wanted_keys
+                    and "expireAfterSeconds" in current_options
+                    and "expireAfterSeconds" in wanted_options
+                    and {k: v for k, v in current_options.items() if k != "expireAfterSeconds"}
+                    == {k: v for k, v in wanted_options.items() if k != "expireAfterSeconds"}
+                )
+                if ttl_only:
+                    await collection.database.command(
+                        "collMod",
+                        collection.name,
+                        index={"name": current_name, "expireAfterSeconds": wanted_options["expireAfterSeconds"]},
+                    )
+                    summary["modified"].append(current_name)
+                    continue
+
+                await collection.drop_index(current_name)
+                await collection.create_index(spec.keys, name=spec.name, background=True, **spec.options)
+                summary["modified"].append(spec.name)
+            else:
+                await collection.create_index(spec.keys, name=spec.name, background=True, **spec.options)
+                summary["created"].append(spec.name)
+        except OperationFailure as e:
+            logger.error(f"Ошибка при создании индекса '{spec.name}' в '{collection.name}': {e}")
+            summary["failed"].append(spec.name)
+
+    elapsed = time.perf_counter() - started
+    changes = {key: value for key, value in summary.items() if value and key != "unchanged"}
+    logger.info(
+        f"Индексы '{collection.name}' проверены за {elapsed:.3f} с: "
+        f"без изменений {len(summary['unchanged'])}, {changes or 'изменений нет'}"
+    )
+    summary["seconds"] = elapsed
+    return summary
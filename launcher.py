@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+import admin_bot
+import user_bot
+from clients import close_clients
+from webhook import BOT_MODE, WebhookConfig, serve_webhook
+
+logger = logging.getLogger(__name__)
+
+# Оба бота в одном процессе и одном цикле событий: общий клиент MongoDB
+# и общий пул HTTP-соединений к Bot API (clients.py), у каждого бота свой
+# диспетчер и свой планировщик отправки.
+#
+#   python launcher.py
+#
+# В режиме webhook (BOT_MODE=webhook) у ботов должны быть разные
+# USER_WEBHOOK_PORT и ADMIN_WEBHOOK_PORT; несколько воркеров
+# (*_WEBHOOK_WORKERS) здесь не поддерживаются.
+
+BOTS = (user_bot, admin_bot)
+
+async def run_polling():
+    # Сигналы обрабатываются здесь: диспетчеры перехватывали бы их друг у друга
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    for module in BOTS:
+        await module.bot.delete_webhook(drop_pending_updates=True)
+    polling = [
+        asyncio.create_task(module.dp.start_polling(module.bot, handle_signals=False))
+        for module in BOTS
+    ]
+    waiter = asyncio.create_task(stop.wait())
+    await asyncio.wait([waiter, *polling], return_when=asyncio.FIRST_COMPLETED)
+
+    # Остановка одного бота (сигнал или ошибка) останавливает оба
+    for module, task in zip(BOTS, polling):
+        if not task.done():
+            with suppress(RuntimeError):
+                await module.dp.stop_polling()
+    waiter.cancel()
+    await asyncio.gather(*polling)
+
+async def run_webhooks():
+    configs = [WebhookConfig("USER_"), WebhookConfig("ADMIN_")]
+    user_config, admin_config = configs
+    if user_config.port == admin_config.port:
+        raise RuntimeError("У ботов одинаковый порт webhook: задайте разные USER_WEBHOOK_PORT и ADMIN_WEBHOOK_PORT")
+    await asyncio.gather(
+        *(
+            serve_webhook(module.dp, module.bot, config, close_shared=False)
+            for module, config in zip(BOTS, configs)
+        )
+    )
+
+async def main():
+    for module in BOTS:
+        module.setup_dispatcher()
+    admin_bot.USER_BOT_IN_PROCESS = True
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhooks()
+        else:
+            await run_polling()
+    finally:
+        await close_clients()
+
+if __name__ == "__main__":
+    with suppress(KeyboardInterrupt):
+        asyncio.run(main())
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from aiogram.types import InputMediaDocument, InputMediaPhoto, InputMediaVideo
+
+logger = logging.getLogger(__name__)
+
+# Максимум элементов в одном send_media_group
+MEDIA_GROUP_LIMIT = 10
+
+INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+}
+
+# Сбор сообщений альбома: Telegram присылает каждый элемент отдельным
+# сообщением с общим media_group_id. Группа считается собранной, если
+# новых элементов не было delay секунд; тогда вызывается on_complete(messages).
+class MediaGroupCollector:
+    def __init__(self, on_complete, delay: float = 1.0):
+        self.on_complete = on_complete
+        self.delay = delay
+        self._groups = {}  # media_group_id -> [сообщения]
+        self._timers = {}  # media_group_id -> asyncio.TimerHandle
+        self._tasks = set()
+
+    def add(self, message):
+        group_id = message.media_group_id
+        self._groups.setdefault(group_id, []).append(message)
+
+        timer = self._timers.get(group_id)
+        if timer is not None:
+            timer.cancel()
+        self._timers[group_id] = asyncio.get_running_loop().call_later(
+            self.delay, self._flush, group_id
+        )
+
+    def _flush(self, group_id):
+        self._timers.pop(group_id, None)
+        messages = self._groups.pop(group_id, [])
+        if not messages:
+            return
+        messages.sort(key=lambda message: message.message_id)
+
+        task = asyncio.create_task(self._complete(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _complete(self, messages):
+        try:
+            await self.on_complete(messages)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке альбома {messages[0].media_group_id}: {e}")
+
+    # Немедленная обработка всех незавершенных альбомов (при остановке бота)
+    async def close(self):
+        for group_id in list(self._timers):
+            self._timers[group_id].cancel()
+            self._flush(group_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# Разбиение элементов {file_id, file_type} на группы для send_media_group.
+# Документы нельзя смешивать с фото и видео, поэтому они идут отдельно.
+def chunk_media(items, size: int = MEDIA_GROUP_LIMIT):
+    visual = [item for item in items if item["file_type"] in ("photo", "video")]
+    documents = [item for item in items if item["file_type"] not in ("photo", "video")]
+
+    chunks = []
+    for group in (visual, documents):
+        for i in range(0, len(group), size):
+            chunks.append(group[i : i + size])
+    return chunks
+
+def build_input_media(items):
+    return [
+        INPUT_MEDIA.get(item["file_type"], InputMediaDocument)(media=item["file_id"])
+        for item in items
+    ]
@@ -0,0 +1,265 @@
+import bisect
+import hmac
+import logging
+import threading
+import time
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from pymongo import monitoring
+from profiler import PROFILE_MAX_SECONDS, profile_process, profile_running, record_io, set_handler
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+# Метрики хранятся по кортежу значений меток. Слушатель MongoDB вызывается
+# из потоков драйвера, поэтому изменения защищены блокировкой.
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+# Значение гистограммы: [счетчики по корзинам, сумма, количество]
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        names = self.label_names + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {count}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+# Реестр метрик процесса. Кроме обычных метрик в него можно добавить
+# источник статистики: функцию, возвращающую словарь чисел (например,
+# TTLCache.stats()); значения отдаются как gauge с префиксом имени.
+class Registry:
+    def __init__(self, namespace: str = "bot"):
+        self.namespace = namespace
+        self._metrics = []
+        self._stats_sources = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        return self._add(Counter(f"{self.namespace}_{name}", help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels=()) -> Gauge:
+        return self._add(Gauge(f"{self.namespace}_{name}", help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(f"{self.namespace}_{name}", help_text, labels, buckets))
+
+    def register_stats(self, name: str, stats):
+        self._stats_sources.append((f"{self.namespace}_{name}", stats))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self._stats_sources:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"Ошибка при сборе статистики {prefix}: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+# Реестр по умолчанию: один на процесс бота
+REGISTRY = Registry()
+
+UPDATES_IN_FLIGHT = REGISTRY.gauge("updates_in_flight", "Обновления, которые сейчас обрабатываются")
+UPDATE_SECONDS = REGISTRY.histogram("update_seconds", "Полное время обработки обновления", ("event_type",))
+HANDLER_SECONDS = REGISTRY.histogram("handler_seconds", "Время работы хэндлера", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("handler_errors_total", "Исключения в хэндлерах", ("handler", "error"))
+MONGO_SECONDS = REGISTRY.histogram("mongo_command_seconds", "Время команд MongoDB", ("command",))
+MONGO_ERRORS = REGISTRY.counter("mongo_command_errors_total", "Ошибки команд MongoDB", ("command",))
+TELEGRAM_SECONDS = REGISTRY.histogram("telegram_request_seconds", "Время запросов к Bot API", ("method",))
+TELEGRAM_ERRORS = REGISTRY.counter("telegram_request_errors_total", "Ошибки запросов к Bot API", ("method", "error"))
+
+# Внешний middleware диспетчера: число обновлений в обработке и полное
+# время обработки (dp.update.outer_middleware)
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+            UPDATE_SECONDS.observe(time.perf_counter() - started, event_type=event.event_type)
+
+# Внутренний middleware роутера: время и ошибки конкретного хэндлера
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        set_handler(name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+# Middleware сессии Bot: задержка и ошибки запросов к Bot API
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_SECONDS.observe(elapsed, method=name)
+            record_io("telegram", elapsed)
+
+# Слушатель команд драйвера MongoDB (event_listeners клиента Motor).
+# Вызывается в потоке Motor с контекстом вызвавшей корутины, поэтому
+# время команды попадает в профиль текущего обновления.
+class MongoMetricsListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+        record_io("db", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+        MONGO_ERRORS.inc(command=event.command_name)
+        record_io("db", event.duration_micros / 1e6)
+
+# Подключение метрик к диспетчеру и роутерам бота
+def instrument_dispatcher(dp, routers):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for router in routers:
+        router.message.middleware(HandlerMetricsMiddleware())
+        router.callback_query.middleware(HandlerMetricsMiddleware())
+
+# HTTP-сервер с метриками в формате Prometheus (GET /metrics) и выборочным
+# профилем процесса в формате collapsed stacks (GET /profile?seconds=N).
+# Профиль нагружает процесс, поэтому он включается только вместе с
+# profile_token и требует заголовок "Authorization: Bearer <profile_token>".
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY, profile_token: str = None):
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_profile(request):
+        # Байты, а не str: compare_digest не принимает str с не-ASCII символами,
+        # а байты заголовка, не являющиеся UTF-8, aiohttp передает суррогатами
+        authorization = request.headers.get("Authorization", "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(authorization, f"Bearer {profile_token}".encode()):
+            return web.Response(status=403, text="Нужен заголовок Authorization с токеном профиля")
+        try:
+            seconds = float(request.query.get("seconds", "10"))
+        except ValueError:
+            return web.Response(status=400, text="seconds должно быть числом")
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            return web.Response(status=400, text=f"seconds от 0 до {PROFILE_MAX_SECONDS}")
+        if profile_running():
+            return web.Response(status=409, text="Профиль уже снимается")
+        return web.Response(text=await profile_process(seconds), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    if profile_token:
+        app.router.add_get("/profile", handle_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Порт уже занят, например другим воркером webhook
+        logger.warning(f"Метрики не отдаются на {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,178 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Профилирование обработки обновлений.
+#
+# 1. Журнал медленных обновлений: SlowUpdateMiddleware заводит на каждое
+#    обновление UpdateProfile в contextvar, а точки замера (запросы к Bot API,
+#    команды MongoDB, запросы SQLite, ожидание планировщиков обновлений и
+#    отправки) добавляют в него время через record_io(). Если обновление шло
+#    дольше порога, в журнал пишется разбивка: очереди, база, Telegram
+#    и остальное (CPU и ожидание своей очереди в цикле событий).
+#
+# 2. Выборочный профиль процесса на N секунд (sample_process): поток
+#    снимает стек потока цикла событий (где тратится CPU; ожидание событий
+#    в selectors помечается как idle), а задача в цикле снимает цепочки
+#    await всех задач (чего они ждут). Результат — строки
+#    "кадр;кадр;кадр число" (collapsed stacks), которые понимают
+#    flamegraph.pl, speedscope и inferno.
+
+IO_KINDS = ("update_wait", "db", "telegram", "send_wait")
+IO_LABELS = {
+    "update_wait": "очередь обновлений",
+    "db": "база",
+    "telegram": "Telegram",
+    "send_wait": "очередь отправки",
+}
+
+PROFILE_MAX_SECONDS = 120
+# Интервалы выборки: стек потока цикла событий и цепочки await задач
+CPU_SAMPLE_INTERVAL = 0.005
+TASK_SAMPLE_INTERVAL = 0.05
+
+class UpdateProfile:
+    __slots__ = ("update_id", "event_type", "handler", "started", "io", "calls")
+
+    def __init__(self, update_id: int, event_type: str):
+        self.update_id = update_id
+        self.event_type = event_type
+        self.handler = None
+        self.started = time.perf_counter()
+        self.io = dict.fromkeys(IO_KINDS, 0.0)
+        self.calls = dict.fromkeys(IO_KINDS, 0)
+
+_current_profile = contextvars.ContextVar("update_profile", default=None)
+
+# Время ожидания ввода-вывода для текущего обновления. Вызывается и из
+# потоков драйвера MongoDB: Motor копирует контекст в поток исполнителя.
+def record_io(kind: str, seconds: float):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.io[kind] += seconds
+        profile.calls[kind] += 1
+
+def set_handler(name: str):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.handler = name
+
+def format_profile(profile: UpdateProfile, elapsed: float) -> str:
+    parts = [
+        f"{IO_LABELS[kind]} {profile.io[kind] * 1000:.0f} мс ({profile.calls[kind]})"
+        for kind in IO_KINDS
+        if profile.calls[kind]
+    ]
+    other = max(0.0, elapsed - sum(profile.io.values()))
+    parts.append(f"остальное {other * 1000:.0f} мс")
+    return (
+        f"Медленное обновление {profile.update_id} ({profile.event_type}, "
+        f"{profile.handler or 'без хэндлера'}): {elapsed * 1000:.0f} мс — " + ", ".join(parts)
+    )
+
+# Внешний middleware диспетчера: журнал обновлений дольше threshold секунд
+class SlowUpdateMiddleware(BaseMiddleware):
+    def __init__(self, threshold: float = 1.0):
+        self.threshold = threshold
+        self.slow_total = 0
+
+    async def __call__(self, handler, event, data):
+        profile = UpdateProfile(event.update_id, event.event_type)
+        token = _current_profile.set(profile)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_profile.reset(token)
+            elapsed = time.perf_counter() - profile.started
+            if elapsed >= self.threshold:
+                self.slow_total += 1
+                logger.warning(format_profile(profile, elapsed))
+
+    def stats(self) -> dict:
+        return {"slow_total": self.slow_total, "threshold_seconds": self.threshold}
+
+# Имя кадра для collapsed stacks: модуль и функция, без номера строки,
+# чтобы выборки одной функции складывались
+def _frame_name(code) -> str:
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+# Цикл событий простаивает: ждет событий ввода-вывода в selector.select()
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return code.co_name == "select" and os.path.basename(code.co_filename) == "selectors.py"
+
+def _thread_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+# Цепочка await задачи от внешней корутины к самой вложенной
+def _await_chain(coro):
+    names = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            # Future или другой объект без кадра: на нем задача и ждет
+            names.append(type(coro).__name__)
+            break
+        names.append(_frame_name(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return names
+
+# Выборочный профиль процесса. Вызывается из цикла событий, который
+# профилируется; возвращает текст в формате collapsed stacks.
+async def sample_process(seconds: float, cpu_interval: float = CPU_SAMPLE_INTERVAL, task_interval: float = TASK_SAMPLE_INTERVAL) -> str:
+    seconds = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+    loop_thread = threading.get_ident()
+    samples = Counter()
+    stop = threading.Event()
+
+    # CPU: где находится поток цикла событий в момент выборки
+    def sample_cpu():
+        while not stop.wait(cpu_interval):
+            frame = sys._current_frames().get(loop_thread)
+            if frame is not None:
+                kind = "idle" if _is_idle(frame) else "cpu"
+                samples[";".join([kind, *_thread_stack(frame)])] += 1
+
+    sampler = threading.Thread(target=sample_cpu, name="profiler", daemon=True)
+    sampler.start()
+    current = asyncio.current_task()
+    deadline = time.monotonic() + seconds
+    try:
+        # await: на чем стоят задачи (кроме самого профилировщика)
+        while time.monotonic() < deadline:
+            for task in asyncio.all_tasks():
+                if task is current or task.done():
+                    continue
+                samples[";".join(["await", *_await_chain(task.get_coro())])] += 1
+            await asyncio.sleep(task_interval)
+    finally:
+        stop.set()
+        sampler.join()
+
+    lines = [f"{stack} {count}" for stack, count in samples.most_common()]
+    logger.info(f"Профиль за {seconds:g} с: {sum(samples.values())} выборок, {len(samples)} стеков")
+    return "\n".join(lines) + "\n"
+
+# Одновременно выполняется только один профиль
+_profile_lock = asyncio.Lock()
+
+def profile_running() -> bool:
+    return _profile_lock.locked()
+
+async def profile_process(seconds: float) -> str:
+    async with _profile_lock:
+        return await sample_process(seconds)
@@ -0,0 +1,164 @@
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+from pymongo import ReturnDocument
+from cache import TTLCache
+from indexes import IndexSpec, ensure_indexes
+
+logger = logging.getLogger(__name__)
+
+# Политика "token bucket": capacity запросов подряд, затем
+# восстановление по capacity запросов за period секунд.
+# Состояние в памяти: (tokens, ts).
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+
+    def apply(self, state, now: float):
+        tokens, ts = state if state else (self.capacity, now)
+        tokens = min(self.capacity, tokens + max(0.0, now - ts) * self.rate)
+        if tokens >= 1:
+            return (tokens - 1, now), 0.0
+        return (tokens, now), (1 - tokens) / self.rate
+
+    # Та же логика одним атомарным update с pipeline
+    def mongo_pipeline(self, now: float, expires_at: datetime):
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$ts", now]}]}]}
+        return [
+            {"$set": {
+                "tokens": {"$min": [
+                    self.capacity,
+                    {"$add": [{"$ifNull": ["$tokens", self.capacity]}, {"$multiply": [elapsed, self.rate]}]},
+                ]},
+                "ts": now,
+            }},
+            {"$set": {"retry_after": {"$cond": [
+                {"$gte": ["$tokens", 1]}, 0, {"$divide": [{"$subtract": [1, "$tokens"]}, self.rate]},
+            ]}}},
+            {"$set": {
+                "tokens": {"$cond": [{"$eq": ["$retry_after", 0]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                "expires_at": expires_at,
+            }},
+        ]
+
+# Политика "скользящее окно": не больше limit запросов за period секунд.
+# Состояние в памяти: кортеж времен последних запросов (не длиннее limit).
+class SlidingWindow:
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+
+    def apply(self, state, now: float):
+        hits = tuple(ts for ts in (state or ()) if ts > now - self.period)
+        if len(hits) < self.limit:
+            return hits + (now,), 0.0
+        return hits, hits[0] + self.period - now
+
+    def mongo_pipeline(self, now: float, expires_at: datetime):
+        return [
+            {"$set": {"hits": {"$filter": {
+                "input": {"$ifNull": ["$hits", []]},
+                "cond": {"$gt": ["$$this", now - self.period]},
+            }}}},
+            {"$set": {"retry_after": {"$cond": [
+                {"$lt": [{"$size": "$hits"}, self.limit]},
+                0,
+                {"$subtract": [{"$add": [{"$arrayElemAt": ["$hits", 0]}, self.period]}, now]},
+            ]}}},
+            {"$set": {
+                "hits": {"$cond": [{"$eq": ["$retry_after", 0]}, {"$concatArrays": ["$hits", [now]]}, "$hits"]},
+                "expires_at": expires_at,
+            }},
+        ]
+
+POLICIES = {"bucket": TokenBucket, "window": SlidingWindow}
+
+# Разбор описания политики вида "bucket:30/60" или "window:1/120"
+def parse_policy(spec: str):
+    try:
+        kind, limits = spec.strip().split(":", 1)
+        count, period = limits.split("/", 1)
+        return POLICIES[kind](int(count), float(period))
+    except (KeyError, ValueError):
+        raise ValueError(f"Некорректное описание лимита: {spec!r}")
+
+# Хранилище состояний в памяти процесса: ограничено по размеру,
+# записи удаляются после истечения периода политики
+class MemoryBackend:
+    def __init__(self, maxsize: int = 100000):
+        self._states = TTLCache(maxsize=maxsize)
+
+    async def hit(self, key: str, policy, now: float) -> float:
+        state, retry_after = policy.apply(self._states.get(key), now)
+        self._states.set(key, state, ttl=policy.period)
+        return retry_after
+
+# Общее для всех процессов хранилище в MongoDB
+class MongoBackend:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await ensure_indexes(
+            self.collection, [IndexSpec("expires_at", "expires_at_ttl_index", expireAfterSeconds=0)]
+        )
+
+    async def hit(self, key: str, policy, now: float) -> float:
+        expires_at = datetime.utcnow() + timedelta(seconds=policy.period)
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            policy.mongo_pipeline(now, expires_at),
+            projection={"retry_after": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc["retry_after"]
+
+# Лимиты для действий (list, upload, redeem, ...)
+class RateLimiter:
+    def __init__(self, backend, policies: dict):
+        self.backend = backend
+        self.policies = policies
+
+    # Возвращает 0, если действие разрешено, иначе сколько секунд подождать
+    async def check(self, action: str, user_id: int) -> float:
+        policy = self.policies.get(action)
+        if policy is None:
+            return 0.0
+        try:
+            return await self.backend.hit(f"{action}:{user_id}", policy, time.time())
+        except Exception as e:
+            # При недоступности хранилища пропускаем запрос
+            logger.error(f"Ошибка при проверке лимита {action} для {user_id}: {e}")
+            return 0.0
+
+def retry_text(retry_after: float) -> str:
+    return f"Подождите немного перед следующим запросом ({math.ceil(retry_after)} сек.)"
+
+# Middleware: действие берется из флага хэндлера, например
+# @router.message(F.text == "Ключи", flags={"rate_limit": "list"}).
+# Сообщения альбома пропускаются: альбом — одна загрузка, и лимит
+# проверяется для него целиком после сборки (store_media_group).
+class RateLimitMiddleware(BaseMiddleware):
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+
+    async def __call__(self, handler, event, data):
+        action = get_flag(data, "rate_limit")
+        user = data.get("event_from_user")
+        if not action or user is None:
+            return await handler(event, data)
+        if isinstance(event, types.Message) and event.media_group_id:
+            return await handler(event, data)
+
+        retry_after = await self.limiter.check(action, user.id)
+        if retry_after > 0:
+            if isinstance(event, (types.Message, types.CallbackQuery)):
+                await event.answer(retry_text(retry_after))
+            return None
+        return await handler(event, data)
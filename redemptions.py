@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+# Отдельная коллекция активаций: одна запись на пару (token, user_id).
+# В документе файла хранится только счетчик usage_count.
+REDEMPTIONS_COLLECTION = "redemptions"
+
+# Активации старше срока хранения переносятся сюда фоновой очисткой
+REDEMPTIONS_ARCHIVE_COLLECTION = "redemptions_archive"
+
+# Код ошибки MongoDB при нарушении уникального индекса
+DUPLICATE_KEY_ERROR = 11000
+
+# Повторы записи при недоступности базы (например, выборах в replica set):
+# число попыток и начальная пауза, которая удваивается с каждой попыткой
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.5
+
+# Пары (token, user_id) из entries, уже перенесенные в архив
+async def archived_pairs(db, entries):
+    tokens = list({token for token, _, _ in entries})
+    user_ids = list({user_id for _, user_id, _ in entries})
+    cursor = db[REDEMPTIONS_ARCHIVE_COLLECTION].find(
+        {"token": {"$in": tokens}, "user_id": {"$in": user_ids}}, {"_id": 0, "token": 1, "user_id": 1}
+    )
+    return {(doc["token"], doc["user_id"]) async for doc in cursor}
+
+# Время в том виде, в каком его хранит MongoDB (миллисекунды)
+def _stored_time(value: datetime):
+    return value.replace(microsecond=value.microsecond // 1000 * 1000) if value else value
+
+# Какие из дубликатов записаны этим же пакетом при предыдущей попытке:
+# у такой записи тот же redeemed_at, что у события (время ставится при
+# активации и не меняется при повторах и возврате пакета в очередь)
+async def _own_duplicates(db, entries):
+    cursor = db[REDEMPTIONS_COLLECTION].find(
+        {
+            "token": {"$in": list({token for token, _, _ in entries})},
+            "user_id": {"$in": list({user_id for _, user_id, _ in entries})},
+        },
+        {"_id": 0, "token": 1, "user_id": 1, "redeemed_at": 1},
+    )
+    stored = {(doc["token"], doc["user_id"]): doc.get("redeemed_at") async for doc in cursor}
+    return {
+        (token, user_id) for token, user_id, redeemed_at in entries
+        if redeemed_at is not None and stored.get((token, user_id)) == _stored_time(redeemed_at)
+    }
+
+# Запись пакета активаций [(token, user_id, redeemed_at)] без повторов пар.
+# Пары из архива тоже считаются повторами: перенос в архив не должен
+# позволять пользователю активировать ключ второй раз.
+# Новые пары пишутся одним bulk_write, затем одним bulk_write увеличиваются
+# счетчики usage_count. Возвращает (число дубликатов, число ошибок).
+# Повтор после сетевой ошибки безопасен: пары, которые успела записать
+# прерванная попытка, считаются новыми, а не дубликатами.
+async def write_redemptions(db, entries):
+    archived = await archived_pairs(db, entries)
+    new_entries = [entry for entry in entries if entry[:2] not in archived]
+    duplicates = len(entries) - len(new_entries)
+    entries = new_entries
+    if not entries:
+        return duplicates, 0
+    requests = [
+        InsertOne({"token": token, "user_id": user_id, "redeemed_at": redeemed_at})
+        for token, user_id, redeemed_at in entries
+    ]
+    failed = 0
+    failed_indexes = set()
+    duplicate_indexes = []
+    try:
+        await db[REDEMPTIONS_COLLECTION].bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") == DUPLICATE_KEY_ERROR:
+                duplicate_indexes.append(error["index"])
+            else:
+                failed_indexes.add(error["index"])
+                failed += 1
+                logger.error(f"Ошибка при записи активации: {error.get('errmsg')}")
+
+    if duplicate_indexes:
+        own = await _own_duplicates(db, [entries[index] for index in duplicate_indexes])
+        for index in duplicate_indexes:
+            if entries[index][:2] not in own:
+                failed_indexes.add(index)
+                duplicates += 1
+
+    # Счетчики увеличиваем только для новых пар (token, user_id)
+    counts = Counter(
+        token for index, (token, _, _) in enumerate(entries) if index not in failed_indexes
+    )
+    if counts:
+        await increment_usage_counts(db, counts)
+    return duplicates, failed
+
+# Увеличение usage_count после записи активаций. Активации уже записаны,
+# поэтому при ошибке повторяется только этот шаг: повтор всего пакета
+# принял бы новые пары за дубликаты и счетчики бы не выросли. Если база
+# не ответила и после повторов, в журнал пишутся несохраненные приращения.
+async def increment_usage_counts(db, counts):
+    requests = [
+        UpdateOne({"token": token}, {"$inc": {"usage_count": count}})
+        for token, count in counts.items()
+    ]
+    delay = WRITE_RETRY_DELAY
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            await db["files"].bulk_write(requests, ordered=False)
+            return
+        except Exception as e:
+            if attempt == WRITE_RETRIES:
+                logger.error(f"Счетчики активаций не обновлены после {attempt + 1} попыток: {dict(counts)}: {e}")
+                return
+            logger.warning(f"Ошибка при обновлении счетчиков активаций, повтор через {delay:g} с: {e}")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+# Фоновая пакетная запись активаций (write-behind).
+# Обработчик кладет событие в очередь и сразу отправляет файл, а очередь
+# сбрасывается в хранилище (store.record_redemptions) по размеру пакета
+# или по таймеру. Переполненная очередь блокирует submit (backpressure).
+# Неудачный пакет повторяется с нарастающей паузой, а если база так и не
+# ответила — возвращается в очередь и пишется со следующим пакетом.
+class RedemptionWriter:
+    def __init__(
+        self,
+        store,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        max_retries: int = WRITE_RETRIES,
+        retry_delay: float = WRITE_RETRY_DELAY,
+    ):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self._closed = False
+
+        # Метрики
+        self.flushes = 0
+        self.flushed_total = 0
+        self.duplicates_total = 0
+        self.failed_total = 0
+        self.retries_total = 0
+        self.requeued_total = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, token: str, user_id: int):
+        await self.submit_many([token], user_id)
+
+    # Несколько активаций одного пользователя (ключи из одного сообщения)
+    async def submit_many(self, tokens, user_id: int):
+        now = datetime.utcnow()
+        entries = [(token, user_id, now) for token in tokens]
+        if self._closed or self._task is None:
+            # Без фоновой задачи пишем напрямую, чтобы не потерять события
+            await self.store.record_redemptions(entries)
+            return
+        for entry in entries:
+            await self._queue.put(entry)
+
+    # Остановка с записью всего, что осталось в очереди
+    async def stop(self):
+        if self._task is None:
+            return
+        self._closed = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self.flush(batch)
+            if stopping:
+                return
+
+    async def flush(self, batch):
+        started = time.perf_counter()
+
+        # Дубликаты внутри одного пакета отбрасываем сразу
+        unique = {}
+        for token, user_id, redeemed_at in batch:
+            unique.setdefault((token, user_id), redeemed_at)
+        entries = [(token, user_id, redeemed_at) for (token, user_id), redeemed_at in unique.items()]
+
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                duplicates, failed = await self.store.record_redemptions(entries)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Ошибка при записи пакета активаций ({len(entries)} шт.): {e}")
+                    self._requeue(entries)
+                    return
+                self.retries_total += 1
+                logger.warning(f"Ошибка при записи пакета активаций, повтор через {delay:g} с: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+        self.duplicates_total += duplicates
+        self.failed_total += failed
+
+        elapsed = time.perf_counter() - started
+        self.flushes += 1
+        self.flushed_total += len(batch)
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+
+    # Возврат пакета в очередь после исчерпания повторов. При остановке
+    # возвращать некуда: такие активации учитываются как потерянные.
+    def _requeue(self, entries):
+        for index, entry in enumerate(entries):
+            if self._closed:
+                lost = len(entries) - index
+                self.failed_total += lost
+                logger.error(f"Активации потеряны при остановке: {lost} шт.")
+                return
+            try:
+                self._queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                lost = len(entries) - index
+                self.failed_total += lost
+                logger.error(f"Очередь активаций переполнена, потеряно {lost} шт.")
+                return
+            self.requeued_total += 1
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_maxsize": self._queue.maxsize,
+            "flushes": self.flushes,
+            "flushed_total": self.flushed_total,
+            "duplicates_total": self.duplicates_total,
+            "failed_total": self.failed_total,
+            "retries_total": self.retries_total,
+            "requeued_total": self.requeued_total,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+# Удаление активаций (и их архива) для удаленных токенов
+async def delete_redemptions(db, tokens):
+    tokens = list(tokens)
+    if not tokens:
+        return 0
+    result = await db[REDEMPTIONS_COLLECTION].delete_many({"token": {"$in": tokens}})
+    await db[REDEMPTIONS_ARCHIVE_COLLECTION].delete_many({"token": {"$in": tokens}})
+    return result.deleted_count
+
+# Перенос старых массивов users из документов файлов в коллекцию активаций.
+# Возвращает (перенесено токенов, токенов с ошибкой записи): у вторых
+# массив users остается, и их можно перенести повторным запуском.
+async def migrate_users_arrays(db, batch_size: int = 500):
+    files_collection = db["files"]
+    redemptions_collection = db[REDEMPTIONS_COLLECTION]
+
+    migrated = failed = 0
+    cursor = files_collection.find(
+        {"users": {"$exists": True}}, {"token": 1, "users": 1}
+    ).batch_size(batch_size)
+
+    async for file_doc in cursor:
+        token = file_doc["token"]
+        users = set(file_doc.get("users") or [])
+
+        if users:
+            requests = [
+                InsertOne({"token": token, "user_id": user_id, "redeemed_at": None})
+                for user_id in users
+            ]
+            try:
+                await redemptions_collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # Уже перенесенные пары (token, user_id) пропускаем
+                errors = [
+                    error for error in e.details.get("writeErrors", [])
+                    if error.get("code") != DUPLICATE_KEY_ERROR
+                ]
+                if errors:
+                    logger.error(f"Ошибка при переносе активаций токена {token}: {errors}")
+                    failed += 1
+                    continue
+
+        # Счетчик берем из коллекции активаций, чтобы учесть и новые записи
+        usage_count = await redemptions_collection.count_documents({"token": token})
+        await files_collection.update_one(
+            {"_id": file_doc["_id"]},
+            {"$set": {"usage_count": usage_count}, "$unset": {"users": ""}},
+        )
+        migrated += 1
+
+    if migrated:
+        logger.info(f"Перенесены активации для {migrated} токенов.")
+    if failed:
+        logger.error(f"Не перенесены активации {failed} токенов, перенос повторится при следующем запуске.")
+    return migrated, failed
+
+# Флаг в storage.settings: массивы users уже перенесены
+USERS_MIGRATION_SETTING = "users_arrays_migrated"
+
+# Перенос один раз на базу: поиск по полю users идет без индекса, то есть
+# полным сканированием 'files', и не должен повторяться при каждом запуске.
+# Флаг ставится, только если перенеслось все; одновременный запуск в
+# нескольких воркерах безопасен: перенос идемпотентен.
+async def migrate_users_arrays_once(db, settings, batch_size: int = 500):
+    if await settings.get(USERS_MIGRATION_SETTING):
+        return 0
+    migrated, failed = await migrate_users_arrays(db, batch_size)
+    if not failed:
+        await settings.set(USERS_MIGRATION_SETTING, True)
+    return migrated
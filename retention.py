@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import math
+import re
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Имя записи с политикой хранения в storage.settings
+RETENTION_SETTING = "retention"
+
+# Самый долгий срок в днях: и для ключей, и для архива активаций.
+# Больше datetime не выдерживает (год 9999), да и смысла нет.
+MAX_RETENTION_DAYS = 3650
+
+# Проверка срока в днях; ValueError для отрицательных, бесконечных и
+# больше MAX_RETENTION_DAYS
+def check_days(days: float) -> float:
+    if not math.isfinite(days) or days < 0 or days > MAX_RETENTION_DAYS:
+        raise ValueError(f"Срок должен быть от 0 до {MAX_RETENTION_DAYS} дней")
+    return days
+
+# Политика хранения: срок жизни новых ключей по умолчанию и возраст,
+# после которого активации переносятся в архив (0 — без ограничения)
+class RetentionPolicy:
+    def __init__(self, token_ttl_days: float = 0, redemption_archive_days: float = 0):
+        self.token_ttl_days = token_ttl_days
+        self.redemption_archive_days = redemption_archive_days
+
+    @property
+    def token_ttl(self):
+        return timedelta(days=self.token_ttl_days) if self.token_ttl_days > 0 else None
+
+    def to_dict(self) -> dict:
+        return {
+            "token_ttl_days": self.token_ttl_days,
+            "redemption_archive_days": self.redemption_archive_days,
+        }
+
+    # Значения из хранилища поверх значений по умолчанию (из переменных
+    # окружения); недопустимое сохраненное значение заменяется умолчанием
+    @classmethod
+    def from_dict(cls, data: dict, defaults: "RetentionPolicy"):
+        data = data or {}
+        values = []
+        for name in ("token_ttl_days", "redemption_archive_days"):
+            value = data.get(name, getattr(defaults, name))
+            try:
+                value = check_days(float(value))
+            except (TypeError, ValueError):
+                logger.error(f"Недопустимое значение {name}={value!r} в политике хранения, используется {getattr(defaults, name)}")
+                value = getattr(defaults, name)
+            values.append(value)
+        return cls(*values)
+
+async def load_policy(storage, defaults: RetentionPolicy) -> RetentionPolicy:
+    return RetentionPolicy.from_dict(await storage.settings.get(RETENTION_SETTING), defaults)
+
+async def save_policy(storage, policy: RetentionPolicy):
+    await storage.settings.set(RETENTION_SETTING, policy.to_dict())
+
+# Срок жизни в подписи к файлу: "ttl=7d", "ttl=12h", "ttl=30m", "ttl=7" (дни).
+# "ttl=0" — без срока. Возвращает None, если срок не указан; ValueError,
+# если срок больше MAX_RETENTION_DAYS.
+TTL_PATTERN = re.compile(r"(?:^|\s)ttl=(\d+)([mhd]?)(?=\s|$)", re.IGNORECASE)
+TTL_UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400, "": 86400}
+
+def parse_ttl(text: str):
+    match = TTL_PATTERN.search(text or "")
+    if match is None:
+        return None
+    seconds = int(match.group(1)) * TTL_UNIT_SECONDS[match.group(2).lower()]
+    if seconds > MAX_RETENTION_DAYS * 86400:
+        raise ValueError(f"Срок ключа не может быть больше {MAX_RETENTION_DAYS} дней")
+    return timedelta(seconds=seconds)
+
+# Время истечения нового ключа: срок из подписи, иначе срок по умолчанию
+def expires_at_for(ttl, policy: RetentionPolicy):
+    if ttl is None:
+        ttl = policy.token_ttl
+    if not ttl:
+        return None
+    return datetime.utcnow() + ttl
+
+# Фоновая очистка: удаление истекших ключей вместе с активациями и
+# перенос старых активаций в архив. Работа идет пакетами
+# по batch_size с паузой между ними, чтобы не мешать обработке сообщений.
+# on_expired(tokens) вызывается для удаленных ключей (сброс кэшей).
+async def run_compaction(storage, get_policy, on_expired, interval: float = 3600, batch_size: int = 1000, pause: float = 0.5):
+    while True:
+        try:
+            policy = await get_policy()
+            purged = archived = 0
+
+            while True:
+                tokens = await storage.tokens.purge_expired(batch_size)
+                if tokens:
+                    purged += len(tokens)
+                    await on_expired(tokens)
+                if len(tokens) < batch_size:
+                    break
+                await asyncio.sleep(pause)
+
+            if policy.redemption_archive_days > 0:
+                before = datetime.utcnow() - timedelta(days=policy.redemption_archive_days)
+                while True:
+                    count = await storage.tokens.archive_redemptions(before, batch_size)
+                    archived += count
+                    if count < batch_size:
+                        break
+                    await asyncio.sleep(pause)
+
+            if purged or archived:
+                logger.info(f"Очистка: удалено истекших ключей {purged}, активаций в архиве {archived}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при фоновой очистке: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import suppress
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage,
+    EditMessageText,
+    ForwardMessage,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    SendVideo,
+)
+from profiler import record_io
+from rate_limit import MemoryBackend, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: меньше — раньше
+PRIORITY_DELIVERY = 0  # отправка файлов по ключу
+PRIORITY_INFO = 1  # информационные сообщения
+
+DELIVERY_METHODS = (SendPhoto, SendVideo, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage)
+INFO_METHODS = (SendMessage, EditMessageText)
+
+# Планировщик исходящих сообщений (middleware сессии Bot).
+# Соблюдает общий лимит Telegram (около 30 сообщений в секунду) и лимиты
+# на чат, отдает файлы раньше информационных сообщений и повторяет запрос
+# после TelegramRetryAfter. Остальные методы API проходят без очереди.
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(
+        self,
+        global_rate: int = 30,
+        private_chat_policy: TokenBucket = None,
+        group_chat_policy: TokenBucket = None,
+        max_retries: int = 3,
+    ):
+        self.global_policy = TokenBucket(max(1, int(global_rate)), 1)
+        self.private_chat_policy = private_chat_policy or TokenBucket(3, 3)
+        self.group_chat_policy = group_chat_policy or TokenBucket(20, 60)
+        self.max_retries = max_retries
+
+        self._chat_limits = MemoryBackend()
+        self._global_state = None
+        self._paused_until = 0.0
+        self._waiters = []  # куча (приоритет, номер, future)
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+        # Метрики: ожидание в очереди по приоритетам и повторы
+        self.wait_count = {PRIORITY_DELIVERY: 0, PRIORITY_INFO: 0}
+        self.wait_seconds_total = {PRIORITY_DELIVERY: 0.0, PRIORITY_INFO: 0.0}
+        self.wait_seconds_max = {PRIORITY_DELIVERY: 0.0, PRIORITY_INFO: 0.0}
+        self.retry_after_total = 0
+
+    async def __call__(self, make_request, bot, method):
+        priority = self._priority(method)
+        if priority is None:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_total += 1
+                if attempt == self.max_retries:
+                    raise
+                # Пауза для всей очереди, с нарастанием при повторных отказах
+                delay = e.retry_after * (attempt + 1)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"Telegram попросил подождать {e.retry_after} с ({type(method).__name__}), повтор {attempt + 1}")
+
+    def _priority(self, method):
+        if isinstance(method, DELIVERY_METHODS):
+            return PRIORITY_DELIVERY
+        if isinstance(method, INFO_METHODS):
+            return PRIORITY_INFO
+        return None
+
+    async def _acquire(self, priority: int, chat_id):
+        started = time.monotonic()
+
+        # Лимит на чат: личные чаты и группы ограничиваются по-разному
+        if isinstance(chat_id, int):
+            policy = self.private_chat_policy if chat_id > 0 else self.group_chat_policy
+            while (retry_after := await self._chat_limits.hit(str(chat_id), policy, time.monotonic())) > 0:
+                await asyncio.sleep(retry_after)
+
+        # Общий лимит: очередь с приоритетами
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+
+        waited = time.monotonic() - started
+        record_io("send_wait", waited)
+        self.wait_count[priority] += 1
+        self.wait_seconds_total[priority] += waited
+        self.wait_seconds_max[priority] = max(self.wait_seconds_max[priority], waited)
+
+    async def _dispatch(self):
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            state, retry_after = self.global_policy.apply(self._global_state, now)
+            if retry_after > 0:
+                await asyncio.sleep(retry_after)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Ожидающий запрос был отменен, слот не расходуем
+                continue
+            self._global_state = state
+            future.set_result(None)
+
+    # Остановка при завершении бота: фоновая задача очереди отменяется,
+    # запросы, которые еще ждут своей очереди, получают CancelledError
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    def stats(self) -> dict:
+        stats = {"queue_length": len(self._waiters), "retry_after_total": self.retry_after_total}
+        for priority, name in ((PRIORITY_DELIVERY, "delivery"), (PRIORITY_INFO, "info")):
+            count = self.wait_count[priority]
+            stats[f"{name}_sent"] = count
+            stats[f"{name}_wait_avg_seconds"] = self.wait_seconds_total[priority] / count if count else 0.0
+            stats[f"{name}_wait_max_seconds"] = self.wait_seconds_max[priority]
+        return stats
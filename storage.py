@@ -0,0 +1,1030 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from export import EXPORT_BATCH_SIZE, EXPORT_FIELDS, export_query
+from indexes import (
+    FILES_INDEXES,
+    REDEMPTIONS_ARCHIVE_INDEXES,
+    REDEMPTIONS_INDEXES,
+    USERS_INDEXES,
+    ensure_indexes,
+)
+from profiler import record_io
+from redemptions import (
+    DUPLICATE_KEY_ERROR,
+    REDEMPTIONS_ARCHIVE_COLLECTION,
+    REDEMPTIONS_COLLECTION,
+    delete_redemptions,
+    write_redemptions,
+)
+from token_invalidation import (
+    ensure_invalidation_log,
+    publish_token_invalidation,
+    watch_token_invalidations,
+)
+
+logger = logging.getLogger(__name__)
+
+# Общий слой хранения для обоих ботов: хранилище токенов (файлы,
+# активации, сброс кэша), хранилище пользователей, запросы статистики
+# и накопительные счетчики (rollups) для админских отчетов.
+# Реализации: MongoDB (Motor) и встроенная SQLite для небольших установок.
+STORAGE_BACKENDS = ("mongo", "sqlite")
+
+# Страница ключей по возрастанию id; лишний элемент показывает, что дальше
+# в этом направлении еще есть ключи. Возвращает (ключи, есть ли предыдущая
+# страница, есть ли следующая).
+def _page_result(tokens, direction: str, page_size: int):
+    has_more = len(tokens) > page_size
+    tokens = tokens[:page_size]
+    if direction == "prev":
+        tokens.reverse()
+        return tokens, has_more, True
+    return tokens, direction == "next", has_more
+
+# Счетчики событий: общий итог (TOTALS_BUCKET) и корзина на каждый день UTC
+# ("day:YYYY-MM-DD"). Имена счетчиков: users, redemptions, uploads.<file_type>.
+ROLLUPS_COLLECTION = "rollups"
+TOTALS_BUCKET = "totals"
+
+def _day_bucket(value: datetime = None) -> str:
+    value = value or datetime.utcnow()
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return f"day:{value:%Y-%m-%d}"
+
+# Корзины за последние days дней, начиная с сегодняшней
+def _recent_day_buckets(days: int):
+    today = datetime.utcnow()
+    return [_day_bucket(today - timedelta(days=offset)) for offset in range(days)]
+
+# Пересчитанные счетчики {корзина: Counter} по строкам (день или None, имя, количество)
+def _rollup_buckets(rows):
+    buckets = defaultdict(Counter)
+    for day, name, count in rows:
+        buckets[TOTALS_BUCKET][name] += count
+        if day:
+            buckets[f"day:{day}"][name] += count
+    return buckets
+
+class MongoTokenStore:
+    def __init__(self, db, rollups):
+        self.db = db
+        self.files = db["files"]
+        self.rollups = rollups
+
+    async def prepare(self):
+        await ensure_indexes(self.files, FILES_INDEXES)
+        await ensure_indexes(self.db[REDEMPTIONS_COLLECTION], REDEMPTIONS_INDEXES)
+        await ensure_indexes(self.db[REDEMPTIONS_ARCHIVE_COLLECTION], REDEMPTIONS_ARCHIVE_INDEXES)
+        await ensure_invalidation_log(self.db)
+
+    # Данные для отправки: {file_id, file_type} или {file_type: bundle, items}
+    # Истекшие ключи не выдаются, даже если очистка их еще не удалила
+    async def get(self, token: str):
+        return await self.files.find_one(
+            {"token": token, "$or": [{"expires_at": None}, {"expires_at": {"$gt": datetime.utcnow()}}]},
+            {"_id": 0, "file_id": 1, "file_type": 1, "items": 1, "expires_at": 1},
+        )
+
+    # Несколько ключей одним запросом $in по индексу 'token_index';
+    # возвращает {токен: документ} только для найденных
+    async def get_many(self, tokens):
+        tokens = list(tokens)
+        cursor = self.files.find(
+            {"token": {"$in": tokens}, "$or": [{"expires_at": None}, {"expires_at": {"$gt": datetime.utcnow()}}]},
+            {"_id": 0, "token": 1, "file_id": 1, "file_type": 1, "items": 1, "expires_at": 1},
+        )
+        docs = await cursor.to_list(length=len(tokens))
+        return {doc.pop("token"): doc for doc in docs}
+
+    # Один документ на файл Telegram (file_unique_id): повторная загрузка
+    # возвращает прежний ключ. Возвращает (токен, создан ли новый документ).
+    async def save_file(self, token: str, user_id: int, file_id: str, file_unique_id: str, file_type: str, expires_at: datetime = None):
+        fields = {
+            "token": token,
+            "file_id": file_id,
+            "file_unique_id": file_unique_id,
+            "user_id": user_id,
+            "uploaded_at": datetime.utcnow(),
+            "file_type": file_type,
+            "usage_count": 0,
+        }
+        if expires_at is not None:
+            fields["expires_at"] = expires_at
+
+        for _ in range(2):
+            try:
+                file_doc = await self.files.find_one_and_update(
+                    {"file_unique_id": file_unique_id},
+                    {"$setOnInsert": fields},
+                    projection={"token": 1, "expires_at": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # Тот же файл одновременно сохранил другой запрос
+                file_doc = await self.files.find_one(
+                    {"file_unique_id": file_unique_id}, {"token": 1, "expires_at": 1}
+                )
+            # Прежний ключ этого файла истек, но еще не удален очисткой
+            expired = file_doc.get("expires_at") is not None and file_doc["expires_at"] <= datetime.utcnow()
+            if file_doc["token"] == token or not expired:
+                break
+            await self.delete([file_doc["token"]])
+        created = file_doc["token"] == token
+        if created:
+            await self.rollups.increment({f"uploads.{file_type}": 1})
+        return file_doc["token"], created
+
+    async def save_bundle(self, token: str, user_id: int, items, media_group_id: str, expires_at: datetime = None):
+        file_doc = {
+            "token": token,
+            "items": items,
+            "media_group_id": media_group_id,
+            "user_id": user_id,
+            "uploaded_at": datetime.utcnow(),
+            "file_type": "bundle",
+            "usage_count": 0,
+        }
+        if expires_at is not None:
+            file_doc["expires_at"] = expires_at
+        await self.files.insert_one(file_doc)
+        await self.rollups.increment({"uploads.bundle": 1})
+
+    # Массовая вставка готовых документов (импорт, benchmark.py)
+    async def insert_files(self, docs):
+        await self.files.insert_many(list(docs), ordered=False)
+
+    # Страница ключей пользователя по диапазону _id (индекс user_id + _id)
+    async def page(self, user_id: int, direction: str = None, cursor: str = None, page_size: int = 10):
+        query = {"user_id": user_id}
+        order = 1
+        if direction in ("next", "prev"):
+            # Курсор приходит из данных кнопки, которые присылает клиент
+            try:
+                cursor = ObjectId(cursor)
+            except (InvalidId, TypeError):
+                raise ValueError(f"Неверный курсор страницы: {cursor!r}")
+        if direction == "next":
+            query["_id"] = {"$gt": cursor}
+        elif direction == "prev":
+            query["_id"] = {"$lt": cursor}
+            order = -1
+
+        docs = await (
+            self.files.find(query, {"token": 1, "usage_count": 1})
+            .sort("_id", order)
+            .limit(page_size + 1)
+            .to_list(length=page_size + 1)
+        )
+        tokens = [
+            {"id": str(doc["_id"]), "token": doc["token"], "usage_count": doc.get("usage_count", 0)}
+            for doc in docs
+        ]
+        return _page_result(tokens, direction, page_size)
+
+    # Удаление токенов (только своих, если указан user_id) вместе с их
+    # активациями; возвращает число удаленных токенов
+    async def delete(self, tokens, user_id: int = None) -> int:
+        query = {"token": {"$in": list(tokens)}}
+        if user_id is not None:
+            query["user_id"] = user_id
+            tokens = await self.files.distinct("token", query)
+            if not tokens:
+                return 0
+            query["token"] = {"$in": tokens}
+
+        result = await self.files.delete_many(query)
+        if result.deleted_count:
+            await delete_redemptions(self.db, tokens)
+        return result.deleted_count
+
+    # Какие из токенов есть в базе
+    async def existing(self, tokens):
+        return await self.files.distinct("token", {"token": {"$in": list(tokens)}})
+
+    # Токены пакетами по batch_size в порядке _id; пакеты можно удалять по
+    # ходу обхода. По пользователю — индекс 'files_user_id_index'.
+    async def iter_tokens(self, user_id: int = None, before: datetime = None, batch_size: int = 500):
+        query = {}
+        if user_id is not None:
+            query["user_id"] = user_id
+        if before is not None:
+            query["uploaded_at"] = {"$lt": before}
+        last_id = None
+        while True:
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = await (
+                self.files.find(query, {"token": 1})
+                .sort("_id", 1)
+                .limit(batch_size)
+                .to_list(length=batch_size)
+            )
+            if not docs:
+                return
+            last_id = docs[-1]["_id"]
+            yield [doc["token"] for doc in docs]
+            if len(docs) < batch_size:
+                return
+
+    # Число уникальных активаций токена или None, если токена нет
+    async def usage_count(self, token: str):
+        file_doc = await self.files.find_one({"token": token}, {"usage_count": 1})
+        return file_doc.get("usage_count", 0) if file_doc else None
+
+    async def record_redemptions(self, entries):
+        duplicates, failed = await write_redemptions(self.db, entries)
+        await self.rollups.increment({"redemptions": len(entries) - duplicates - failed})
+        return duplicates, failed
+
+    # Удаление пакета истекших ключей вместе с активациями; возвращает
+    # удаленные токены. TTL-индекс 'files_expires_at_ttl_index' удаляет
+    # документы только спустя EXPIRED_FILES_GRACE_SECONDS.
+    async def purge_expired(self, batch_size: int):
+        now = datetime.utcnow()
+        docs = await (
+            self.files.find({"expires_at": {"$lte": now}}, {"token": 1})
+            .sort("expires_at", 1)
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not docs:
+            return []
+        await self.files.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        tokens = [doc["token"] for doc in docs]
+        await delete_redemptions(self.db, tokens)
+        return tokens
+
+    # Перенос пакета активаций старше before в архивную коллекцию;
+    # возвращает число перенесенных записей
+    async def archive_redemptions(self, before: datetime, batch_size: int) -> int:
+        redemptions = self.db[REDEMPTIONS_COLLECTION]
+        docs = await (
+            redemptions.find({"redeemed_at": {"$lt": before}})
+            .sort("redeemed_at", 1)
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not docs:
+            return 0
+        try:
+            await self.db[REDEMPTIONS_ARCHIVE_COLLECTION].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Пакет, уже частично перенесенный другим процессом
+            errors = [
+                error for error in e.details.get("writeErrors", [])
+                if error.get("code") != DUPLICATE_KEY_ERROR
+            ]
+            if errors:
+                raise
+        await redemptions.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        return len(docs)
+
+    async def publish_invalidation(self, tokens):
+        await publish_token_invalidation(self.db, tokens)
+
+    async def watch_invalidations(self, on_tokens):
+        await watch_token_invalidations(self.db, on_tokens)
+
+class MongoUserStore:
+    def __init__(self, db, rollups):
+        self.users = db["users"]
+        self.rollups = rollups
+
+    async def prepare(self):
+        await ensure_indexes(self.users, USERS_INDEXES)
+
+    # Регистрация пользователя; возвращает True, если он новый
+    async def add(self, user_id: int, joined_at: datetime) -> bool:
+        result = await self.users.update_one(
+            {"user_id": user_id}, {"$setOnInsert": {"joined_at": joined_at}}, upsert=True
+        )
+        if result.upserted_id is None:
+            return False
+        await self.rollups.increment({"users": 1}, joined_at)
+        return True
+
+    async def count(self) -> int:
+        return await self.users.count_documents({})
+
+# Настройки, которые админ меняет во время работы (политика хранения)
+class MongoSettingsStore:
+    def __init__(self, db):
+        self.settings = db["settings"]
+
+    async def get(self, name: str):
+        doc = await self.settings.find_one({"_id": name})
+        return doc["value"] if doc else None
+
+    async def set(self, name: str, value):
+        await self.settings.update_one({"_id": name}, {"$set": {"value": value}}, upsert=True)
+
+class MongoStatsQueries:
+    def __init__(self, db):
+        self.files = db["files"]
+
+    # Самые популярные токены по индексу 'usage_count_index'
+    async def top_tokens(self, limit: int):
+        return await (
+            self.files.find({}, {"_id": 0, "token": 1, "usage_count": 1})
+            .sort("usage_count", -1)
+            .limit(limit)
+            .to_list(length=limit)
+        )
+
+    # Токены для выгрузки по индексу 'uploaded_at_index'
+    def export_rows(self, options: dict):
+        return (
+            self.files.find(export_query(options), {"_id": 0, **{field: 1 for field in EXPORT_FIELDS}})
+            .sort("uploaded_at", 1)
+            .batch_size(EXPORT_BATCH_SIZE)
+        )
+
+class MongoRollupStore:
+    def __init__(self, db):
+        self.db = db
+        self.rollups = db[ROLLUPS_COLLECTION]
+
+    # При первом запуске счетчики заполняются по существующим данным
+    async def prepare(self):
+        if await self.rollups.find_one({"_id": TOTALS_BUCKET}, {"_id": 1}) is None:
+            await self.rebuild()
+
+    # Увеличение счетчиков итога и дня события одним bulk_write
+    async def increment(self, counters: dict, when: datetime = None):
+        counters = {name: value for name, value in counters.items() if value}
+        if not counters:
+            return
+        day = _day_bucket(when)
+        try:
+            await self.rollups.bulk_write(
+                [
+                    UpdateOne({"_id": TOTALS_BUCKET}, {"$inc": counters}, upsert=True),
+                    UpdateOne({"_id": day}, {"$inc": counters}, upsert=True),
+                ],
+                ordered=False,
+            )
+        except Exception as e:
+            # Счетчики не должны ломать основную операцию; /rebuild_stats их исправит
+            logger.error(f"Ошибка при обновлении счетчиков статистики {counters}: {e}")
+
+    # (итог, [(день, счетчики)]) за последние days дней, новые дни первыми
+    async def summary(self, days: int):
+        buckets = _recent_day_buckets(days)
+        docs = await self.rollups.find({"_id": {"$in": [TOTALS_BUCKET] + buckets}}).to_list(length=None)
+        counters = {doc.pop("_id"): self._flatten(doc) for doc in docs}
+        return counters.get(TOTALS_BUCKET, {}), [(bucket[4:], counters.get(bucket, {})) for bucket in buckets]
+
+    def _flatten(self, doc: dict, prefix: str = "") -> dict:
+        flat = {}
+        for key, value in doc.items():
+            if isinstance(value, dict):
+                flat.update(self._flatten(value, f"{prefix}{key}."))
+            else:
+                flat[f"{prefix}{key}"] = value
+        return flat
+
+    # Полный пересчет счетчиков по пользователям, файлам и активациям
+    # (включая перенесенные в архив). Корзины заменяются целиком, поэтому
+    # повторный запуск безопасен.
+    async def rebuild(self) -> int:
+        def by_day(field: str):
+            return {"$dateToString": {"format": "%Y-%m-%d", "date": f"${field}"}}
+
+        rows = []
+        async for row in self.db["users"].aggregate(
+            [{"$group": {"_id": by_day("joined_at"), "count": {"$sum": 1}}}]
+        ):
+            rows.append((row["_id"], "users", row["count"]))
+        async for row in self.db["files"].aggregate(
+            [{"$group": {"_id": {"day": by_day("uploaded_at"), "file_type": "$file_type"}, "count": {"$sum": 1}}}]
+        ):
+            rows.append((row["_id"].get("day"), f"uploads.{row['_id'].get('file_type')}", row["count"]))
+        for collection in (REDEMPTIONS_COLLECTION, REDEMPTIONS_ARCHIVE_COLLECTION):
+            async for row in self.db[collection].aggregate(
+                [{"$group": {"_id": by_day("redeemed_at"), "count": {"$sum": 1}}}]
+            ):
+                rows.append((row["_id"], "redemptions", row["count"]))
+
+        buckets = _rollup_buckets(rows)
+        buckets.setdefault(TOTALS_BUCKET, Counter())
+        requests = [DeleteMany({"_id": {"$nin": list(buckets)}})]
+        for bucket, counters in buckets.items():
+            doc = {}
+            for name, value in counters.items():
+                group, _, key = name.partition(".")
+                if key:
+                    doc.setdefault(group, {})[key] = value
+                else:
+                    doc[name] = value
+            requests.append(ReplaceOne({"_id": bucket}, doc, upsert=True))
+        await self.rollups.bulk_write(requests, ordered=True)
+        logger.info(f"Счетчики статистики пересчитаны: {len(buckets)} корзин.")
+        return len(buckets)
+
+# Время в SQLite хранится строкой ISO 8601 в UTC без часового пояса,
+# как и в MongoDB; такие строки сравниваются в хронологическом порядке
+def _to_text(value: datetime):
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+def _from_text(value: str):
+    return datetime.fromisoformat(value) if value else None
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    token TEXT NOT NULL UNIQUE,
+    user_id INTEGER NOT NULL,
+    file_id TEXT,
+    file_unique_id TEXT UNIQUE,
+    file_type TEXT NOT NULL,
+    items TEXT,
+    media_group_id TEXT,
+    uploaded_at TEXT NOT NULL,
+    usage_count INTEGER NOT NULL DEFAULT 0,
+    expires_at TEXT
+);
+CREATE INDEX IF NOT EXISTS files_user_id_index ON files (user_id, id);
+CREATE INDEX IF NOT EXISTS uploaded_at_index ON files (uploaded_at);
+CREATE INDEX IF NOT EXISTS usage_count_index ON files (usage_count DESC);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    joined_at TEXT
+);
+CREATE TABLE IF NOT EXISTS redemptions (
+    token TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    redeemed_at TEXT,
+    PRIMARY KEY (token, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS redeemed_at_index ON redemptions (redeemed_at);
+CREATE TABLE IF NOT EXISTS redemptions_archive (
+    token TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    redeemed_at TEXT,
+    PRIMARY KEY (token, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS token_invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tokens TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (bucket, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Изменения схемы для баз, созданных предыдущими версиями:
+# (таблица, столбец, определение)
+SQLITE_COLUMNS = (
+    ("files", "expires_at", "TEXT"),
+)
+
+# Подключение к SQLite. Все запросы выполняются в одном отдельном потоке,
+# поэтому одно соединение используется последовательно и не блокирует
+# цикл событий. Журнал WAL позволяет читать, пока другой процесс пишет.
+# SQL-строки постоянные, с параметрами: sqlite3 кэширует их
+# подготовленные выражения (cached_statements).
+class SQLiteDatabase:
+    def __init__(self, path: str, busy_timeout: int = 5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection = None
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, cached_statements=256
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        return connection
+
+    def _call(self, fn, args):
+        if self._connection is None:
+            self._connection = self._connect()
+        return fn(self._connection, *args)
+
+    # fn(connection, *args) выполняется в потоке SQLite; время вместе с
+    # ожиданием потока попадает в профиль текущего обновления
+    async def run(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+        finally:
+            record_io("db", time.perf_counter() - started)
+
+    # То же внутри транзакции BEGIN IMMEDIATE ... COMMIT
+    async def transaction(self, fn, *args):
+        def run_in_transaction(connection, *args):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(connection, *args)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+        return await self.run(run_in_transaction, *args)
+
+    async def execute(self, sql: str, params=()) -> int:
+        return await self.run(lambda connection: connection.execute(sql, params).rowcount)
+
+    async def fetchone(self, sql: str, params=()):
+        row = await self.run(lambda connection: connection.execute(sql, params).fetchone())
+        return dict(row) if row is not None else None
+
+    async def fetchall(self, sql: str, params=()):
+        rows = await self.run(lambda connection: connection.execute(sql, params).fetchall())
+        return [dict(row) for row in rows]
+
+    async def close(self):
+        if self._connection is not None:
+            await self.run(lambda connection: connection.close())
+            self._connection = None
+        self._executor.shutdown(wait=False)
+
+class SQLiteTokenStore:
+    # Сколько хранить записи о сброшенных токенах (аналог capped-коллекции)
+    INVALIDATIONS_KEEP = timedelta(hours=1)
+
+    def __init__(self, database: SQLiteDatabase, rollups, poll_interval: float = 1.0):
+        self.database = database
+        self.rollups = rollups
+        self.poll_interval = poll_interval
+
+    async def prepare(self):
+        def prepare(connection):
+            connection.executescript(SQLITE_SCHEMA)
+            for table, column, definition in SQLITE_COLUMNS:
+                columns = {row["name"] for row in connection.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            connection.execute("CREATE INDEX IF NOT EXISTS files_expires_at_index ON files (expires_at)")
+
+        await self.database.run(prepare)
+
+    # Истекшие ключи не выдаются, даже если очистка их еще не удалила
+    async def get(self, token: str):
+        row = await self.database.fetchone(
+            "SELECT file_id, file_type, items, expires_at FROM files"
+            " WHERE token = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (token, _to_text(datetime.utcnow())),
+        )
+        if row is None:
+            return None
+        return self._file_doc(row)
+
+    async def get_many(self, tokens):
+        tokens = list(tokens)
+        placeholders = ", ".join("?" * len(tokens))
+        rows = await self.database.fetchall(
+            "SELECT token, file_id, file_type, items, expires_at FROM files"
+            f" WHERE token IN ({placeholders}) AND (expires_at IS NULL OR expires_at > ?)",
+            (*tokens, _to_text(datetime.utcnow())),
+        )
+        return {row.pop("token"): self._file_doc(row) for row in rows}
+
+    def _file_doc(self, row: dict):
+        file_doc = {key: value for key, value in row.items() if value is not None}
+        if "items" in file_doc:
+            file_doc["items"] = json.loads(file_doc["items"])
+        if "expires_at" in file_doc:
+            file_doc["expires_at"] = _from_text(file_doc["expires_at"])
+        return file_doc
+
+    async def save_file(self, token: str, user_id: int, file_id: str, file_unique_id: str, file_type: str, expires_at: datetime = None):
+        def save(connection):
+            now = _to_text(datetime.utcnow())
+            # Прежний ключ этого файла истек, но еще не удален очисткой
+            expired = connection.execute(
+                "SELECT token FROM files WHERE file_unique_id = ? AND expires_at <= ?", (file_unique_id, now)
+            ).fetchone()
+            if expired is not None:
+                self._delete_file(connection, expired["token"])
+            inserted = connection.execute(
+                "INSERT INTO files (token, user_id, file_id, file_unique_id, file_type, uploaded_at, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (file_unique_id) DO NOTHING",
+                (token, user_id, file_id, file_unique_id, file_type, now, _to_text(expires_at)),
+            ).rowcount
+            if inserted:
+                self.rollups.apply(connection, {f"uploads.{file_type}": 1})
+            return connection.execute(
+                "SELECT token FROM files WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()["token"]
+
+        stored_token = await self.database.transaction(save)
+        return stored_token, stored_token == token
+
+    async def save_bundle(self, token: str, user_id: int, items, media_group_id: str, expires_at: datetime = None):
+        def save(connection):
+            connection.execute(
+                "INSERT INTO files (token, user_id, file_type, items, media_group_id, uploaded_at, expires_at)"
+                " VALUES (?, ?, 'bundle', ?, ?, ?, ?)",
+                (token, user_id, json.dumps(items), media_group_id, _to_text(datetime.utcnow()), _to_text(expires_at)),
+            )
+            self.rollups.apply(connection, {"uploads.bundle": 1})
+
+        await self.database.transaction(save)
+
+    async def insert_files(self, docs):
+        rows = [
+            (
+                doc["token"],
+                doc["user_id"],
+                doc.get("file_id"),
+                doc.get("file_unique_id"),
+                doc["file_type"],
+                json.dumps(doc["items"]) if doc.get("items") else None,
+                doc.get("media_group_id"),
+                _to_text(doc["uploaded_at"]),
+                doc.get("usage_count", 0),
+            )
+            for doc in docs
+        ]
+        await self.database.transaction(
+            lambda connection: connection.executemany(
+                "INSERT OR IGNORE INTO files (token, user_id, file_id, file_unique_id, file_type,"
+                " items, media_group_id, uploaded_at, usage_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        )
+
+    async def page(self, user_id: int, direction: str = None, cursor: str = None, page_size: int = 10):
+        if direction in ("next", "prev"):
+            # Курсор приходит из данных кнопки, которые присылает клиент
+            try:
+                cursor = int(cursor)
+            except (ValueError, TypeError):
+                raise ValueError(f"Неверный курсор страницы: {cursor!r}")
+        if direction == "next":
+            sql = "SELECT id, token, usage_count FROM files WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?"
+            params = (user_id, cursor, page_size + 1)
+        elif direction == "prev":
+            sql = "SELECT id, token, usage_count FROM files WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+            params = (user_id, cursor, page_size + 1)
+        else:
+            sql = "SELECT id, token, usage_count FROM files WHERE user_id = ? ORDER BY id LIMIT ?"
+            params = (user_id, page_size + 1)
+
+        rows = await self.database.fetchall(sql, params)
+        for row in rows:
+            row["id"] = str(row["id"])
+        return _page_result(rows, direction, page_size)
+
+    # Удаление ключа вместе с активациями и архивом внутри транзакции;
+    # общее для delete, purge_expired и замены истекшего ключа в save_file
+    @staticmethod
+    def _delete_file(connection, token: str, user_id: int = None) -> bool:
+        if user_id is None:
+            cursor = connection.execute("DELETE FROM files WHERE token = ?", (token,))
+        else:
+            cursor = connection.execute("DELETE FROM files WHERE token = ? AND user_id = ?", (token, user_id))
+        if not cursor.rowcount:
+            return False
+        connection.execute("DELETE FROM redemptions WHERE token = ?", (token,))
+        connection.execute("DELETE FROM redemptions_archive WHERE token = ?", (token,))
+        return True
+
+    async def delete(self, tokens, user_id: int = None) -> int:
+        def delete(connection):
+            return sum(self._delete_file(connection, token, user_id) for token in tokens)
+
+        return await self.database.transaction(delete)
+
+    async def existing(self, tokens):
+        tokens = list(tokens)
+        placeholders = ", ".join("?" * len(tokens))
+        rows = await self.database.fetchall(
+            f"SELECT token FROM files WHERE token IN ({placeholders})", tokens
+        )
+        return [row["token"] for row in rows]
+
+    async def iter_tokens(self, user_id: int = None, before: datetime = None, batch_size: int = 500):
+        conditions, params = ["id > ?"], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if before is not None:
+            conditions.append("uploaded_at < ?")
+            params.append(_to_text(before))
+        sql = f"SELECT id, token FROM files WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        last_id = 0
+        while True:
+            rows = await self.database.fetchall(sql, (last_id, *params, batch_size))
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            yield [row["token"] for row in rows]
+            if len(rows) < batch_size:
+                return
+
+    async def usage_count(self, token: str):
+        row = await self.database.fetchone("SELECT usage_count FROM files WHERE token = ?", (token,))
+        return row["usage_count"] if row else None
+
+    # Пакет активаций в одной транзакции; счетчик растет только для новых пар,
+    # которых нет ни среди активаций, ни в архиве
+    async def record_redemptions(self, entries):
+        def record(connection):
+            duplicates = 0
+            for token, user_id, redeemed_at in entries:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO redemptions (token, user_id, redeemed_at)"
+                    " SELECT ?, ?, ? WHERE NOT EXISTS"
+                    " (SELECT 1 FROM redemptions_archive WHERE token = ? AND user_id = ?)",
+                    (token, user_id, _to_text(redeemed_at), token, user_id),
+                )
+                if cursor.rowcount:
+                    connection.execute(
+                        "UPDATE files SET usage_count = usage_count + 1 WHERE token = ?", (token,)
+                    )
+                else:
+                    duplicates += 1
+            self.rollups.apply(connection, {"redemptions": len(entries) - duplicates})
+            return duplicates, 0
+
+        return await self.database.transaction(record)
+
+    # Удаление пакета истекших ключей вместе с активациями;
+    # возвращает удаленные токены
+    async def purge_expired(self, batch_size: int):
+        def purge(connection):
+            rows = connection.execute(
+                "SELECT token FROM files WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (_to_text(datetime.utcnow()), batch_size),
+            ).fetchall()
+            tokens = [row["token"] for row in rows]
+            for token in tokens:
+                self._delete_file(connection, token)
+            return tokens
+
+        return await self.database.transaction(purge)
+
+    # Перенос пакета активаций старше before в архивную таблицу
+    async def archive_redemptions(self, before: datetime, batch_size: int) -> int:
+        def archive(connection):
+            rows = connection.execute(
+                "SELECT token, user_id, redeemed_at FROM redemptions"
+                " WHERE redeemed_at < ? ORDER BY redeemed_at LIMIT ?",
+                (_to_text(before), batch_size),
+            ).fetchall()
+            pairs = [(row["token"], row["user_id"]) for row in rows]
+            connection.executemany(
+                "INSERT OR IGNORE INTO redemptions_archive (token, user_id, redeemed_at) VALUES (?, ?, ?)",
+                [tuple(row) for row in rows],
+            )
+            connection.executemany("DELETE FROM redemptions WHERE token = ? AND user_id = ?", pairs)
+            return len(pairs)
+
+        return await self.database.transaction(archive)
+
+    async def publish_invalidation(self, tokens):
+        tokens = list(tokens)
+        if not tokens:
+            return
+        now = datetime.utcnow()
+
+        def publish(connection):
+            connection.execute(
+                "INSERT INTO token_invalidations (tokens, created_at) VALUES (?, ?)",
+                (json.dumps(tokens), _to_text(now)),
+            )
+            connection.execute(
+                "DELETE FROM token_invalidations WHERE created_at < ?",
+                (_to_text(now - self.INVALIDATIONS_KEEP),),
+            )
+
+        await self.database.transaction(publish)
+
+    # Опрос новых записей о сброшенных токенах (в SQLite нет tailable-курсоров)
+    async def watch_invalidations(self, on_tokens):
+        row = await self.database.fetchone("SELECT MAX(id) AS last_id FROM token_invalidations")
+        last_id = row["last_id"] or 0
+        while True:
+            try:
+                rows = await self.database.fetchall(
+                    "SELECT id, tokens FROM token_invalidations WHERE id > ? ORDER BY id", (last_id,)
+                )
+                for row in rows:
+                    on_tokens(json.loads(row["tokens"]))
+                    last_id = row["id"]
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при чтении 'token_invalidations': {e}")
+            await asyncio.sleep(self.poll_interval)
+
+class SQLiteUserStore:
+    def __init__(self, database: SQLiteDatabase, rollups):
+        self.database = database
+        self.rollups = rollups
+
+    async def prepare(self):
+        # Таблицы создает SQLiteTokenStore.prepare
+        pass
+
+    async def add(self, user_id: int, joined_at: datetime) -> bool:
+        def add(connection):
+            inserted = connection.execute(
+                "INSERT OR IGNORE INTO users (user_id, joined_at) VALUES (?, ?)", (user_id, _to_text(joined_at))
+            ).rowcount
+            if inserted:
+                self.rollups.apply(connection, {"users": 1}, joined_at)
+            return inserted > 0
+
+        return await self.database.transaction(add)
+
+    async def count(self) -> int:
+        row = await self.database.fetchone("SELECT COUNT(*) AS count FROM users")
+        return row["count"]
+
+# Настройки, которые админ меняет во время работы (политика хранения)
+class SQLiteSettingsStore:
+    def __init__(self, database: SQLiteDatabase):
+        self.database = database
+
+    async def get(self, name: str):
+        row = await self.database.fetchone("SELECT value FROM settings WHERE name = ?", (name,))
+        return json.loads(row["value"]) if row else None
+
+    async def set(self, name: str, value):
+        await self.database.execute(
+            "INSERT INTO settings (name, value) VALUES (?, ?)"
+            " ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (name, json.dumps(value)),
+        )
+
+class SQLiteStatsQueries:
+    def __init__(self, database: SQLiteDatabase):
+        self.database = database
+
+    async def top_tokens(self, limit: int):
+        return await self.database.fetchall(
+            "SELECT token, usage_count FROM files ORDER BY usage_count DESC LIMIT ?", (limit,)
+        )
+
+    # Построчная выгрузка порциями по EXPORT_BATCH_SIZE
+    async def export_rows(self, options: dict):
+        params = (_to_text(options["start"]), _to_text(options["end"]))
+        sql = (
+            "SELECT token, user_id, file_type, usage_count, uploaded_at FROM files"
+            " WHERE uploaded_at >= ? AND uploaded_at < ? ORDER BY uploaded_at"
+        )
+        if options["user_id"] is not None:
+            sql = (
+                "SELECT token, user_id, file_type, usage_count, uploaded_at FROM files"
+                " WHERE uploaded_at >= ? AND uploaded_at < ? AND user_id = ? ORDER BY uploaded_at"
+            )
+            params += (options["user_id"],)
+
+        cursor = await self.database.run(lambda connection: connection.execute(sql, params))
+        try:
+            while True:
+                rows = await self.database.run(lambda connection: cursor.fetchmany(EXPORT_BATCH_SIZE))
+                if not rows:
+                    return
+                for row in rows:
+                    doc = dict(row)
+                    doc["uploaded_at"] = _from_text(doc["uploaded_at"])
+                    yield doc
+        finally:
+            await self.database.run(lambda connection: cursor.close())
+
+class SQLiteRollupStore:
+    def __init__(self, database: SQLiteDatabase):
+        self.database = database
+
+    async def prepare(self):
+        row = await self.database.fetchone(
+            "SELECT COUNT(*) AS count FROM rollups WHERE bucket = ?", (TOTALS_BUCKET,)
+        )
+        if not row["count"]:
+            await self.rebuild()
+
+    # Увеличение счетчиков внутри уже открытой транзакции
+    def apply(self, connection, counters: dict, when: datetime = None):
+        day = _day_bucket(when)
+        connection.executemany(
+            "INSERT INTO rollups (bucket, name, value) VALUES (?, ?, ?)"
+            " ON CONFLICT (bucket, name) DO UPDATE SET value = value + excluded.value",
+            [
+                (bucket, name, value)
+                for name, value in counters.items() if value
+                for bucket in (TOTALS_BUCKET, day)
+            ],
+        )
+
+    async def increment(self, counters: dict, when: datetime = None):
+        await self.database.transaction(self.apply, counters, when)
+
+    async def summary(self, days: int):
+        buckets = _recent_day_buckets(days)
+        rows = await self.database.fetchall(
+            "SELECT bucket, name, value FROM rollups WHERE bucket = ? OR (bucket >= ? AND bucket <= ?)",
+            (TOTALS_BUCKET, buckets[-1], buckets[0]),
+        )
+        counters = defaultdict(dict)
+        for row in rows:
+            counters[row["bucket"]][row["name"]] = row["value"]
+        return counters.get(TOTALS_BUCKET, {}), [(bucket[4:], counters.get(bucket, {})) for bucket in buckets]
+
+    async def rebuild(self) -> int:
+        def rebuild(connection):
+            rows = []
+            for day, count in connection.execute(
+                "SELECT substr(joined_at, 1, 10), COUNT(*) FROM users GROUP BY 1"
+            ):
+                rows.append((day, "users", count))
+            for day, file_type, count in connection.execute(
+                "SELECT substr(uploaded_at, 1, 10), file_type, COUNT(*) FROM files GROUP BY 1, 2"
+            ):
+                rows.append((day, f"uploads.{file_type}", count))
+            for table in ("redemptions", "redemptions_archive"):
+                for day, count in connection.execute(
+                    f"SELECT substr(redeemed_at, 1, 10), COUNT(*) FROM {table} GROUP BY 1"
+                ):
+                    rows.append((day, "redemptions", count))
+
+            buckets = _rollup_buckets(rows)
+            connection.execute("DELETE FROM rollups")
+            connection.executemany(
+                "INSERT INTO rollups (bucket, name, value) VALUES (?, ?, ?)",
+                [(bucket, name, value) for bucket, counters in buckets.items() for name, value in counters.items()],
+            )
+            # Пустой итог отмечает, что пересчет уже выполнялся
+            connection.execute(
+                "INSERT OR IGNORE INTO rollups (bucket, name, value) VALUES (?, 'users', 0)", (TOTALS_BUCKET,)
+            )
+            return len(buckets)
+
+        count = await self.database.transaction(rebuild)
+        logger.info(f"Счетчики статистики пересчитаны: {count} корзин.")
+        return count
+
+# Хранилище целиком: storage.tokens, storage.users, storage.stats,
+# storage.rollups, storage.settings
+class Storage:
+    def __init__(self, tokens, users, stats, rollups, settings, database: SQLiteDatabase = None):
+        self.tokens = tokens
+        self.users = users
+        self.stats = stats
+        self.rollups = rollups
+        self.settings = settings
+        self.database = database
+
+    # Схема, индексы и служебные коллекции
+    async def prepare(self):
+        await self.tokens.prepare()
+        await self.users.prepare()
+        await self.rollups.prepare()
+
+    async def close(self):
+        if self.database is not None:
+            await self.database.close()
+
+# Выбор хранилища по значению переменной окружения STORAGE_BACKEND
+def create_storage(kind: str, db=None, sqlite_path: str = "bot.db") -> Storage:
+    if kind == "mongo":
+        rollups = MongoRollupStore(db)
+        return Storage(
+            MongoTokenStore(db, rollups),
+            MongoUserStore(db, rollups),
+            MongoStatsQueries(db),
+            rollups,
+            MongoSettingsStore(db),
+        )
+    if kind != "sqlite":
+        raise ValueError(f"Неизвестное хранилище: {kind!r}")
+    database = SQLiteDatabase(sqlite_path)
+    rollups = SQLiteRollupStore(database)
+    return Storage(
+        SQLiteTokenStore(database, rollups),
+        SQLiteUserStore(database, rollups),
+        SQLiteStatsQueries(database),
+        rollups,
+        SQLiteSettingsStore(database),
+        database,
+    )
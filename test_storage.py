@@ -0,0 +1,165 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from storage import create_storage
+
+# Контрактные тесты слоя хранения: поведение, на которое рассчитывают
+# боты, одинаковое для всех реализаций. Запускаются на SQLite без сети:
+#
+#   python -m pytest -q   или   python -m unittest test_storage
+#
+# Для другой реализации достаточно наследника с своим make_storage().
+class StorageContract:
+    async def make_storage(self):
+        raise NotImplementedError
+
+    async def asyncSetUp(self):
+        self.storage = await self.make_storage()
+        await self.storage.prepare()
+        self.tokens = self.storage.tokens
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    async def save(self, token: str, user_id: int = 1, unique_id: str = None, expires_at: datetime = None):
+        return await self.tokens.save_file(
+            token, user_id, f"file-{token}", unique_id or f"unique-{token}", "document", expires_at=expires_at
+        )
+
+    # save_file: один документ на файл Telegram
+    async def test_save_file_returns_existing_token_for_same_file(self):
+        self.assertEqual(await self.save("first", unique_id="same"), ("first", True))
+        self.assertEqual(await self.save("second", unique_id="same"), ("first", False))
+        self.assertEqual(await self.tokens.get("first"), {"file_id": "file-first", "file_type": "document"})
+        self.assertIsNone(await self.tokens.get("second"))
+
+    async def test_expired_token_is_hidden_and_replaced_on_upload(self):
+        past = datetime.utcnow() - timedelta(minutes=1)
+        await self.save("old", unique_id="same", expires_at=past)
+        self.assertIsNone(await self.tokens.get("old"))
+        self.assertEqual(await self.tokens.get_many(["old"]), {})
+
+        self.assertEqual(await self.save("new", unique_id="same"), ("new", True))
+        self.assertIsNotNone(await self.tokens.get("new"))
+
+    async def test_replaced_expired_token_starts_without_redemptions(self):
+        await self.save("old", unique_id="same", expires_at=datetime.utcnow() - timedelta(minutes=1))
+        await self.tokens.record_redemptions([("old", 1, datetime.utcnow() - timedelta(days=10))])
+        self.assertEqual(await self.tokens.archive_redemptions(datetime.utcnow() - timedelta(days=1), 100), 1)
+        await self.tokens.record_redemptions([("old", 2, datetime.utcnow())])
+
+        self.assertEqual(await self.save("new", unique_id="same"), ("new", True))
+        # Ключ с тем же именем не наследует активации и архив прежнего
+        await self.save("old", unique_id="another")
+        self.assertEqual(await self.tokens.record_redemptions([("old", 1, datetime.utcnow())]), (0, 0))
+        self.assertEqual(await self.tokens.usage_count("old"), 1)
+
+    async def test_purge_expired_removes_keys_and_redemptions(self):
+        await self.save("old", expires_at=datetime.utcnow() - timedelta(minutes=1))
+        await self.save("live", expires_at=datetime.utcnow() + timedelta(days=1))
+        await self.tokens.record_redemptions([("old", 2, datetime.utcnow())])
+
+        self.assertEqual(await self.tokens.purge_expired(10), ["old"])
+        self.assertEqual(await self.tokens.purge_expired(10), [])
+        self.assertIsNone(await self.tokens.usage_count("old"))
+        self.assertEqual(await self.tokens.existing(["old", "live"]), ["live"])
+
+    # page: листание ключей пользователя по курсору
+    async def test_page_walks_forward_and_back(self):
+        for number in range(25):
+            await self.save(f"t{number:02}")
+        await self.save("other", user_id=2)
+
+        tokens, has_prev, has_next = await self.tokens.page(1, page_size=10)
+        self.assertEqual([t["token"] for t in tokens], [f"t{n:02}" for n in range(10)])
+        self.assertEqual((has_prev, has_next), (False, True))
+
+        second, has_prev, has_next = await self.tokens.page(1, "next", tokens[-1]["id"], page_size=10)
+        self.assertEqual([t["token"] for t in second], [f"t{n:02}" for n in range(10, 20)])
+        self.assertEqual((has_prev, has_next), (True, True))
+
+        last, has_prev, has_next = await self.tokens.page(1, "next", second[-1]["id"], page_size=10)
+        self.assertEqual([t["token"] for t in last], [f"t{n:02}" for n in range(20, 25)])
+        self.assertEqual((has_prev, has_next), (True, False))
+
+        back, has_prev, has_next = await self.tokens.page(1, "prev", second[0]["id"], page_size=10)
+        self.assertEqual(back, tokens)
+        self.assertEqual((has_prev, has_next), (False, True))
+
+    async def test_page_rejects_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            await self.tokens.page(1, "next", "not-a-cursor")
+
+    # delete: только свои ключи, вместе с активациями
+    async def test_delete_checks_owner_and_drops_redemptions(self):
+        await self.save("mine", user_id=1)
+        await self.save("theirs", user_id=2)
+        await self.tokens.record_redemptions([("mine", 3, datetime.utcnow())])
+
+        self.assertEqual(await self.tokens.delete(["mine", "theirs"], user_id=1), 1)
+        self.assertIsNone(await self.tokens.get("mine"))
+        self.assertIsNotNone(await self.tokens.get("theirs"))
+        self.assertEqual(await self.tokens.delete(["missing"]), 0)
+
+        # Ключ с тем же именем начинается без старых активаций
+        await self.save("mine", unique_id="another")
+        self.assertEqual(await self.tokens.usage_count("mine"), 0)
+
+    # record_redemptions: счетчик уникальных пользователей
+    async def test_record_redemptions_counts_unique_users(self):
+        await self.save("token")
+        now = datetime.utcnow()
+        self.assertEqual(await self.tokens.record_redemptions([("token", 1, now), ("token", 2, now)]), (0, 0))
+        self.assertEqual(await self.tokens.record_redemptions([("token", 2, now), ("token", 3, now)]), (1, 0))
+        self.assertEqual(await self.tokens.usage_count("token"), 3)
+        self.assertIsNone(await self.tokens.usage_count("missing"))
+
+    async def test_archived_redemption_is_not_counted_again(self):
+        await self.save("token")
+        await self.tokens.record_redemptions([("token", 1, datetime.utcnow() - timedelta(days=10))])
+        self.assertEqual(await self.tokens.archive_redemptions(datetime.utcnow() - timedelta(days=1), 100), 1)
+
+        self.assertEqual(await self.tokens.record_redemptions([("token", 1, datetime.utcnow())]), (1, 0))
+        self.assertEqual(await self.tokens.usage_count("token"), 1)
+
+    # rollups: накопительные счетчики совпадают с пересчетом по данным
+    async def test_rollups_follow_writes_and_rebuild(self):
+        now = datetime.utcnow()
+        await self.save("a")
+        await self.save("b")
+        await self.save("a-again", unique_id="unique-a")
+        await self.tokens.save_bundle("bundle", 1, [{"file_id": "x", "file_type": "photo"}], "group")
+        await self.tokens.record_redemptions([("a", 1, now), ("a", 2, now), ("a", 1, now)])
+        self.assertTrue(await self.storage.users.add(1, now))
+        self.assertFalse(await self.storage.users.add(1, now))
+
+        expected = {"uploads.document": 2, "uploads.bundle": 1, "redemptions": 2, "users": 1}
+        totals, days = await self.storage.rollups.summary(7)
+        self.assertEqual(totals, expected)
+        self.assertEqual(len(days), 7)
+        self.assertEqual(days[0][1], expected)
+
+        await self.storage.rollups.rebuild()
+        totals, _ = await self.storage.rollups.summary(7)
+        self.assertEqual(totals, expected)
+
+    async def test_rebuild_counts_archived_redemptions(self):
+        await self.save("token")
+        old = datetime.utcnow() - timedelta(days=30)
+        await self.tokens.record_redemptions([("token", user_id, old) for user_id in range(5)])
+        self.assertEqual(await self.tokens.archive_redemptions(datetime.utcnow() - timedelta(days=1), 100), 5)
+
+        await self.storage.rollups.rebuild()
+        totals, _ = await self.storage.rollups.summary(7)
+        self.assertEqual(totals["redemptions"], 5)
+
+class SQLiteStorageTest(StorageContract, unittest.IsolatedAsyncioTestCase):
+    async def make_storage(self):
+        directory = tempfile.mkdtemp(prefix="storage-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return create_storage("sqlite", sqlite_path=os.path.join(directory, "test.db"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from datetime import datetime
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+# Capped-коллекция, через которую админский бот сообщает пользовательскому
+# об удаленных токенах, чтобы тот сбросил их из своего кэша
+INVALIDATIONS_COLLECTION = "token_invalidations"
+INVALIDATIONS_SIZE_BYTES = 1024 * 1024
+
+# Создание capped-коллекции (если ее еще нет)
+async def ensure_invalidation_log(db):
+    try:
+        await db.create_collection(
+            INVALIDATIONS_COLLECTION, capped=True, size=INVALIDATIONS_SIZE_BYTES
+        )
+        logger.info(f"Коллекция '{INVALIDATIONS_COLLECTION}' создана.")
+    except CollectionInvalid:
+        pass
+
+# Публикация списка удаленных токенов
+async def publish_token_invalidation(db, tokens):
+    tokens = list(tokens)
+    if not tokens:
+        return
+    await db[INVALIDATIONS_COLLECTION].insert_one(
+        {"tokens": tokens, "created_at": datetime.utcnow()}
+    )
+
+# Фоновое чтение новых записей; on_tokens вызывается со списком токенов
+async def watch_token_invalidations(db, on_tokens, retry_delay: float = 1.0):
+    collection = db[INVALIDATIONS_COLLECTION]
+
+    # Старые записи не интересны: начинаем с последней существующей
+    last = await collection.find_one(sort=[("$natural", -1)])
+    query = {"_id": {"$gt": last["_id"]}} if last else {}
+
+    while True:
+        try:
+            cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for doc in cursor:
+                    on_tokens(doc.get("tokens", []))
+                    query = {"_id": {"$gt": doc["_id"]}}
+                await asyncio.sleep(retry_delay)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при чтении '{INVALIDATIONS_COLLECTION}': {e}")
+        await asyncio.sleep(retry_delay)
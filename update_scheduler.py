@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from contextlib import nullcontext
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from metrics import REGISTRY
+from profiler import record_io
+
+logger = logging.getLogger(__name__)
+
+# Полосы обработки: дешевые обновления (меню, команды, кнопки) не ждут,
+# пока заняты слоты дорогих (загрузки и выдача файлов по ключу)
+LANE_CHEAP = "cheap"
+LANE_EXPENSIVE = "expensive"
+LANES = (LANE_CHEAP, LANE_EXPENSIVE)
+
+UPDATE_QUEUE_SECONDS = REGISTRY.histogram(
+    "update_queue_seconds", "Ожидание обновления в очереди планировщика", ("lane",)
+)
+UPDATES_SHED = REGISTRY.counter(
+    "updates_shed_total", "Обновления, отброшенные при переполнении очереди", ("lane", "reason")
+)
+
+# Полоса по умолчанию: файлы в сообщении — дорогая, остальное — дешевая
+def classify_update(update) -> str:
+    message = update.message
+    if message is not None and (message.document or message.photo or message.video):
+        return LANE_EXPENSIVE
+    return LANE_CHEAP
+
+# Очередь одного пользователя: блокировка сохраняет порядок его обновлений
+# (FIFO), pending — сколько его обновлений ждут или выполняются
+class _UserQueue:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+# Планировщик обновлений (внешний middleware диспетчера, dp.update).
+# Обновления одного пользователя выполняются строго по очереди, поэтому
+# состояние FSM не гоняется между ними; регистрировать его нужно до
+# FSMContextMiddleware. Одновременно выполняется не больше max_concurrency
+# обновлений, из них дорогих — не больше expensive_concurrency. Если в
+# очереди уже max_queue обновлений или у пользователя max_user_queue,
+# новое отбрасывается (пользователю отправляется shed_text, если задан).
+class UpdateScheduler(BaseMiddleware):
+    def __init__(
+        self,
+        classify=classify_update,
+        max_concurrency: int = 100,
+        expensive_concurrency: int = 30,
+        max_queue: int = 2000,
+        max_user_queue: int = 10,
+        shed_text: str = None,
+    ):
+        self.classify = classify
+        self.max_concurrency = max_concurrency
+        self.expensive_concurrency = min(expensive_concurrency, max_concurrency)
+        self.max_queue = max_queue
+        self.max_user_queue = max_user_queue
+        self.shed_text = shed_text
+
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._expensive = asyncio.Semaphore(self.expensive_concurrency)
+        self._users = {}  # user_id -> _UserQueue
+
+        # Метрики
+        self.queued = {lane: 0 for lane in LANES}
+        self.running = {lane: 0 for lane in LANES}
+        self.processed = {lane: 0 for lane in LANES}
+        self.shed = {lane: 0 for lane in LANES}
+        self.wait_seconds_max = {lane: 0.0 for lane in LANES}
+
+    async def __call__(self, handler, event, data):
+        lane = self.classify(event)
+        user = data.get("event_from_user")
+        user_queue = self._users.get(user.id) if user is not None else None
+
+        if sum(self.queued.values()) >= self.max_queue:
+            return await self._shed(event, lane, "queue_full")
+        if user_queue is not None and user_queue.pending >= self.max_user_queue:
+            return await self._shed(event, lane, "user_queue_full")
+
+        if user is not None and user_queue is None:
+            user_queue = self._users[user.id] = _UserQueue()
+
+        started = time.monotonic()
+        self.queued[lane] += 1
+        waiting = True
+        if user_queue is not None:
+            user_queue.pending += 1
+        try:
+            async with user_queue.lock if user_queue is not None else nullcontext():
+                async with self._expensive if lane == LANE_EXPENSIVE else nullcontext():
+                    async with self._global:
+                        waiting = False
+                        self.queued[lane] -= 1
+                        self._observe_wait(lane, time.monotonic() - started)
+                        self.running[lane] += 1
+                        try:
+                            return await handler(event, data)
+                        finally:
+                            self.running[lane] -= 1
+                            self.processed[lane] += 1
+        finally:
+            if waiting:
+                self.queued[lane] -= 1
+            if user_queue is not None:
+                user_queue.pending -= 1
+                if user_queue.pending == 0:
+                    self._users.pop(user.id, None)
+
+    def _observe_wait(self, lane: str, waited: float):
+        UPDATE_QUEUE_SECONDS.observe(waited, lane=lane)
+        record_io("update_wait", waited)
+        self.wait_seconds_max[lane] = max(self.wait_seconds_max[lane], waited)
+
+    async def _shed(self, event, lane: str, reason: str):
+        self.shed[lane] += 1
+        UPDATES_SHED.inc(lane=lane, reason=reason)
+        logger.warning(f"Обновление {event.update_id} отброшено ({lane}, {reason})")
+        if not self.shed_text:
+            return None
+        try:
+            if event.callback_query is not None:
+                await event.callback_query.answer(self.shed_text)
+            elif event.message is not None:
+                await event.message.answer(self.shed_text)
+        except TelegramAPIError as e:
+            logger.error(f"Не удалось сообщить об отброшенном обновлении: {e}")
+        return None
+
+    def stats(self) -> dict:
+        stats = {"users": len(self._users)}
+        for lane in LANES:
+            stats[f"{lane}_queued"] = self.queued[lane]
+            stats[f"{lane}_running"] = self.running[lane]
+            stats[f"{lane}_processed"] = self.processed[lane]
+            stats[f"{lane}_shed"] = self.shed[lane]
+            stats[f"{lane}_wait_max_seconds"] = self.wait_seconds_max[lane]
+        return stats
@@ -1,13 +1,15 @@
 import os
+import re
 import logging
 import secrets
-import motor.motor_asyncio
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
 )
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.filters.callback_data import CallbackData
 from aiogram import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
@@ -15,28 +17,125 @@ from dotenv import load_dotenv
 import time
 import asyncio
 from datetime import datetime
-from pymongo.errors import OperationFailure
+from cache import TTLCache
+from redemptions import RedemptionWriter, migrate_users_arrays_once
+from retention import RetentionPolicy, expires_at_for, load_policy, parse_ttl, run_compaction
+from storage import MongoTokenStore, create_storage
+from rate_limit import (
+    MemoryBackend,
+    MongoBackend,
+    RateLimiter,
+    RateLimitMiddleware,
+    parse_policy,
+    retry_text,
+)
+from webhook import BOT_MODE, run_webhook
+from fsm_storage import MongoStorage, create_fsm_storage
+from media_groups import MediaGroupCollector, build_input_media, chunk_media
+from send_scheduler import SendScheduler
+from update_scheduler import LANE_CHEAP, LANE_EXPENSIVE, UpdateScheduler
+from profiler import SlowUpdateMiddleware
+from clients import close_clients, create_bot_session, get_mongo_client
+from metrics import (
+    REGISTRY,
+    TelegramMetricsMiddleware,
+    instrument_dispatcher,
+    start_metrics_server,
+)
+from aiogram.exceptions import TelegramBadRequest
 
 # Загрузка переменных окружения
 load_dotenv()
 
 TOKEN = os.getenv("USER_BOT_TOKEN")  # Токен бота для пользователей
-MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB = os.getenv("MONGO_DB", "telegram_bot_db")
+
+# Хранилище токенов и пользователей: mongo (по умолчанию) или sqlite (один файл)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
 CHANNEL_ID = os.getenv("CHANNEL_ID")  # Идентификатор вашего канала
 
+# Хранилище состояний FSM: memory (по умолчанию) или mongo (общее для процессов)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "1.0"))
+
+# Настройки кэша проверки подписки (TTL в секундах)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "50000"))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "600"))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", "60"))
+
+# Настройки кэша токенов (TTL в секундах)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "100000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.getenv("TOKEN_CACHE_NEGATIVE_TTL", "30"))
+
+# Сколько ключей из одного сообщения обрабатывается, остальные пропускаются
+REDEEM_MAX_TOKENS = int(os.getenv("REDEEM_MAX_TOKENS", "20"))
+
+# Настройки кэша ссылок на файлы (TTL в секундах)
+FILE_URL_CACHE_SIZE = int(os.getenv("FILE_URL_CACHE_SIZE", "10000"))
+FILE_URL_CACHE_TTL = float(os.getenv("FILE_URL_CACHE_TTL", "3000"))
+
+# Сколько секунд ждать следующий элемент альбома
+MEDIA_GROUP_DELAY = float(os.getenv("MEDIA_GROUP_DELAY", "1.0"))
+
+# Настройки пакетной записи активаций
+REDEMPTION_BATCH_SIZE = int(os.getenv("REDEMPTION_BATCH_SIZE", "500"))
+REDEMPTION_FLUSH_INTERVAL = float(os.getenv("REDEMPTION_FLUSH_INTERVAL", "1.0"))
+REDEMPTION_QUEUE_SIZE = int(os.getenv("REDEMPTION_QUEUE_SIZE", "10000"))
+
+# Политика хранения по умолчанию (дни, 0 — без ограничения); админ может
+# изменить ее командой /retention. Фоновая очистка: период и размер пакета.
+TOKEN_TTL_DAYS = float(os.getenv("TOKEN_TTL_DAYS", "0"))
+REDEMPTION_ARCHIVE_DAYS = float(os.getenv("REDEMPTION_ARCHIVE_DAYS", "0"))
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "3600"))
+COMPACTION_BATCH_SIZE = int(os.getenv("COMPACTION_BATCH_SIZE", "1000"))
+
+# Ограничение частоты запросов: memory (в процессе) или mongo (общее для воркеров).
+# Лимиты задаются как "bucket:<запросов>/<секунд>" или "window:<запросов>/<секунд>"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MEMORY_SIZE = int(os.getenv("RATE_LIMIT_MEMORY_SIZE", "100000"))
+RATE_LIMITS = {
+    "list": os.getenv("RATE_LIMIT_LIST", "window:1/120"),
+    "upload": os.getenv("RATE_LIMIT_UPLOAD", "bucket:20/60"),
+    "redeem": os.getenv("RATE_LIMIT_REDEEM", "bucket:30/60"),
+    "page": os.getenv("RATE_LIMIT_PAGE", "bucket:20/60"),
+}
+
+# Исходящие сообщения: общий лимит в секунду и число повторов после RetryAfter
+SEND_GLOBAL_RATE = int(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Входящие обновления: сколько обрабатывать одновременно (из них дорогих —
+# загрузок и выдачи файлов), сколько держать в очереди всего и от одного
+# пользователя; лишние отбрасываются
+UPDATE_MAX_CONCURRENCY = int(os.getenv("UPDATE_MAX_CONCURRENCY", "100"))
+UPDATE_EXPENSIVE_CONCURRENCY = int(os.getenv("UPDATE_EXPENSIVE_CONCURRENCY", "30"))
+UPDATE_MAX_QUEUE = int(os.getenv("UPDATE_MAX_QUEUE", "2000"))
+UPDATE_MAX_USER_QUEUE = int(os.getenv("UPDATE_MAX_USER_QUEUE", "10"))
+
+# Журнал медленных обновлений: порог в секундах (0 — не писать)
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
+
+# Метрики в формате Prometheus: порт HTTP-сервера (0 — не запускать)
+METRICS_HOST = os.getenv("USER_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("USER_METRICS_PORT", "0"))
+# Секрет для GET /profile на сервере метрик (не задан — профиль по HTTP выключен)
+PROFILE_TOKEN = os.getenv("USER_PROFILE_TOKEN")
+
+# Количество ключей на одной странице списка 'Ключи'
+TOKENS_PAGE_SIZE = 10
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Асинхронное подключение к MongoDB
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
-db = client["telegram_bot_db"]
-users_collection = db["users"]
-files_collection = db["files"]
-
-# Создание бота и диспетчера
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Подключение к базе, бот и диспетчер создаются в create_clients() при
+# запуске, а не при импорте модуля
+client = db = storage = redemption_writer = None
+bot = send_scheduler = fsm_storage = dp = update_scheduler = None
+rate_limit_backend = rate_limiter = None
 
 # Роутер для регистрации хэндлеров
 router = Router()
@@ -45,31 +144,109 @@ router = Router()
 def generate_token() -> str:
     return secrets.token_urlsafe(16)
 
-# Ограничение количества запросов от пользователя
-user_last_token_request = {}
-
-async def rate_limit(user_id: int, limit_time: int = 120) -> bool:
-    last_request_time = user_last_token_request.get(user_id)
-    current_time = int(time.time())
+# Формат токенов из generate_token: 22 символа base64url
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]{22}")
+
+def looks_like_token(text: str) -> bool:
+    return TOKEN_PATTERN.fullmatch(text) is not None
+
+# Ключи внутри текста: отдельные слова из 22 символов base64url,
+# без повторов, в порядке появления
+TOKEN_SEARCH_PATTERN = re.compile(r"(?<![A-Za-z0-9_-])[A-Za-z0-9_-]{22}(?![A-Za-z0-9_-])")
+
+def find_tokens(text: str):
+    return list(dict.fromkeys(TOKEN_SEARCH_PATTERN.findall(text or "")))
+
+# Кэш популярных токенов: token -> {file_id, file_type} или {file_type: bundle, items}.
+# Отсутствующие токены кэшируются как None на меньшее время.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+# Ключ со сроком жизни не должен оставаться в кэше после истечения
+def token_cache_ttl(file_info) -> float:
+    if not file_info:
+        return TOKEN_CACHE_NEGATIVE_TTL
+    if file_info.get("expires_at") is not None:
+        remaining = (file_info["expires_at"] - datetime.utcnow()).total_seconds()
+        return min(TOKEN_CACHE_TTL, remaining)
+    return TOKEN_CACHE_TTL
+
+def invalidate_tokens(tokens):
+    for token in tokens:
+        token_cache.pop(token)
+
+# Поиск файла по токену: текст, не похожий на токен, в базу не попадает
+async def get_token_file(token: str):
+    if not looks_like_token(token):
+        return None
+    return await token_cache.get_or_load(
+        token, lambda: storage.tokens.get(token), ttl_for=token_cache_ttl
+    )
 
-    if last_request_time and current_time - last_request_time < limit_time:
-        return False
-    user_last_token_request[user_id] = current_time
-    return True
+# Поиск нескольких токенов: закэшированные берутся из кэша, остальные
+# загружаются одним запросом storage.tokens.get_many и кэшируются.
+# Возвращает {токен: документ или None}.
+async def get_token_files(tokens):
+    if len(tokens) == 1:
+        return {tokens[0]: await get_token_file(tokens[0])}
+
+    missing = object()
+    files = {}
+    to_load = []
+    for token in tokens:
+        file_doc = token_cache.get(token, missing)
+        if file_doc is missing:
+            to_load.append(token)
+        else:
+            files[token] = file_doc
+
+    if to_load:
+        loaded = await storage.tokens.get_many(to_load)
+        for token in to_load:
+            file_doc = loaded.get(token)
+            token_cache.set(token, file_doc, token_cache_ttl(file_doc))
+            files[token] = file_doc
+    return files
+
+# Ссылки на скачивание файлов получаются только при необходимости
+# и кэшируются (Telegram гарантирует работу ссылки не меньше часа)
+file_url_cache = TTLCache(maxsize=FILE_URL_CACHE_SIZE, ttl=FILE_URL_CACHE_TTL)
+
+async def resolve_file_url(file_id: str) -> str:
+    async def load():
+        file_info = await bot.get_file(file_id)
+        return bot.session.api.file_url(bot.token, file_info.file_path)
+    return await file_url_cache.get_or_load(file_id, load)
+
+# Данные кнопок листания списка ключей: направление и _id крайнего ключа
+class TokensPage(CallbackData, prefix="tokens"):
+    direction: str  # "next" или "prev"
+    cursor: str
 
 # FSM классы для обработки состояний
 class DeleteTokenState(StatesGroup):
     waiting_for_token = State()
 
+# Кэш статусов подписки: подписанных помним дольше, неподписанных меньше,
+# чтобы после подписки пользователь быстро увидел изменения
+subscription_cache = TTLCache(maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+
+def subscription_ttl(is_subscribed: bool) -> float:
+    return SUBSCRIPTION_CACHE_TTL if is_subscribed else SUBSCRIPTION_CACHE_NEGATIVE_TTL
+
+async def fetch_subscription_status(user_id: int) -> bool:
+    member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+    return member.status in ['creator', 'administrator', 'member']
+
 # Функция для проверки подписки пользователя
 async def is_user_subscribed(user_id: int) -> bool:
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        if member.status in ['creator', 'administrator', 'member']:
-            return True
-        else:
-            return False
+        return await subscription_cache.get_or_load(
+            user_id,
+            lambda: fetch_subscription_status(user_id),
+            ttl_for=subscription_ttl,
+        )
     except Exception as e:
+        # Ошибки не кэшируем, следующий запрос повторит проверку
         logger.error(f"Ошибка при проверке подписки пользователя {user_id}: {e}")
         return False
 
@@ -77,9 +254,7 @@ async def is_user_subscribed(user_id: int) -> bool:
 @router.message(F.text == "/start")
 async def start(message: types.Message):
     user_id = message.from_user.id
-    user = await users_collection.find_one({"user_id": user_id})
-    if not user:
-        await users_collection.insert_one({"user_id": user_id, "joined_at": message.date})
+    await storage.users.add(user_id, message.date)
 
     # Создаем клавиатуру для пользователей
     markup = ReplyKeyboardMarkup(
@@ -106,33 +281,63 @@ async def send_channel_info(message: types.Message):
     )
 
 # Хэндлер для команды 'Ключи'
-@router.message(F.text == "Ключи")
+@router.message(F.text == "Ключи", flags={"rate_limit": "list"})
 async def list_user_tokens(message: types.Message):
     user_id = message.from_user.id
 
-    # Проверка на лимит запросов
-    if not await rate_limit(user_id):
-        await message.answer("Подождите немного перед следующим запросом (60 сек.)")
+    tokens, has_prev, has_next = await storage.tokens.page(user_id, page_size=TOKENS_PAGE_SIZE)
+    if not tokens:
+        await message.answer("У вас нет сохраненных ключей.")
         return
 
-    tokens_cursor = files_collection.find(
-        {"user_id": user_id}, {"_id": 0, "token": 1, "users": 1}
-    )
-    tokens = await tokens_cursor.to_list(length=None)
+    text, markup = render_tokens_page(tokens, has_prev, has_next)
+    await message.answer(text, reply_markup=markup, parse_mode="Markdown")
 
+# Листание списка ключей: одно сообщение редактируется на месте
+@router.callback_query(TokensPage.filter(), flags={"rate_limit": "page"})
+async def page_user_tokens(callback: types.CallbackQuery, callback_data: TokensPage):
+    try:
+        tokens, has_prev, has_next = await storage.tokens.page(
+            callback.from_user.id, callback_data.direction, callback_data.cursor, page_size=TOKENS_PAGE_SIZE
+        )
+    except ValueError as e:
+        logger.warning(f"Листание ключей {callback.from_user.id}: {e}")
+        await callback.answer("Список устарел, откройте 'Ключи' заново.")
+        return
     if not tokens:
-        await message.answer("У вас нет сохраненных ключей.")
+        await callback.answer("Больше ключей нет.")
         return
 
+    text, markup = render_tokens_page(tokens, has_prev, has_next)
+    try:
+        await callback.message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        # Страница не изменилась (повторное нажатие): редактировать нечего
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
+
+# Страница ключей: текст и кнопки листания с id крайних ключей
+def render_tokens_page(tokens, has_prev: bool, has_next: bool):
     # Использование Markdown для удобного копирования токенов
-    token_list = [
-        f'`{token["token"]}` — Использований: {len(token.get("users", []))}'
+    text = "\n".join(
+        f'`{token["token"]}` — Использований: {token["usage_count"]}'
         for token in tokens
-    ]
-    message_chunks = [token_list[i : i + 10] for i in range(0, len(token_list), 10)]
+    )
 
-    for chunk in message_chunks:
-        await message.answer("\n".join(chunk), parse_mode="Markdown")
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            text="« Назад",
+            callback_data=TokensPage(direction="prev", cursor=tokens[0]["id"]).pack(),
+        ))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            text="Вперед »",
+            callback_data=TokensPage(direction="next", cursor=tokens[-1]["id"]).pack(),
+        ))
+    markup = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return text, markup
 
 # Хэндлер команды 'Стереть ключ'
 @router.message(F.text == "Стереть ключ")
@@ -145,53 +350,56 @@ async def process_user_token_deletion(message: types.Message, state: FSMContext)
     token = message.text.strip()
     user_id = message.from_user.id
 
-    file_doc = await files_collection.find_one({"token": token, "user_id": user_id})
-    if file_doc:
-        await files_collection.delete_one({"token": token, "user_id": user_id})
+    if await storage.tokens.delete([token], user_id=user_id):
+        invalidate_tokens([token])
+        # Остальные процессы бота сбросят ключ из своих кэшей
+        await storage.tokens.publish_invalidation([token])
         await message.answer(f"Ключ {token} был успешно стерт.")
     else:
         await message.answer("Ключ не найден или не принадлежит вам.")
 
     await state.clear()
 
-# Обработчик загрузки файла (документ)
-@router.message(F.content_type == "document")
-async def handle_file(message: types.Message):
-    user_id = message.from_user.id
+# Политика хранения из storage.settings; кэшируется, чтобы не читать
+# ее при каждой загрузке (изменения из админского бота видны через минуту)
+retention_defaults = RetentionPolicy(TOKEN_TTL_DAYS, REDEMPTION_ARCHIVE_DAYS)
+retention_cache = TTLCache(maxsize=1, ttl=60)
 
-    # Проверка подписки
-    is_subscribed = await is_user_subscribed(user_id)
-    if not is_subscribed:
-        await message.answer(
-            f"Чтобы быть в курсе новостей и получать обновления, подпишитесь на наш канал: {CHANNEL_ID}"
-        )
-
-    # Получаем информацию о файле через метод get_file
-    file_info = await bot.get_file(message.document.file_id)
-    file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
-
-    token = generate_token()
-
-    await files_collection.insert_one(
-        {
-            "token": token,
-            "file_id": message.document.file_id,
-            "file_url": file_url,
-            "user_id": user_id,
-            "uploaded_at": datetime.utcnow(),
-            "file_type": "document",
-            "users": [],
-        }
+async def get_retention_policy() -> RetentionPolicy:
+    return await retention_cache.get_or_load(
+        "policy", lambda: load_policy(storage, retention_defaults)
     )
 
-    await message.answer(
-        f"Файл сохранен. Можете поделиться им, просто отправьте этот ключ боту: `{token}`",
-        parse_mode="Markdown",
+# Срок действия нового ключа: "ttl=..." в подписи или срок по умолчанию;
+# ValueError, если срок в подписи слишком большой
+async def upload_expires_at(caption: str):
+    return expires_at_for(parse_ttl(caption), await get_retention_policy())
+
+def expiry_text(expires_at) -> str:
+    if expires_at is None:
+        return ""
+    return f"\nКлюч действует до {expires_at:%d.%m.%Y %H:%M} UTC."
+
+# Удаление истекших ключей фоновой очисткой: сброс кэшей всех процессов
+async def on_tokens_expired(tokens):
+    invalidate_tokens(tokens)
+    await storage.tokens.publish_invalidation(tokens)
+
+# Сохранение загруженного файла. Один и тот же файл (file_unique_id)
+# хранится в одном документе: повторная загрузка возвращает прежний ключ.
+# Возвращает (токен, создан ли новый документ).
+async def store_file(user_id: int, file_id: str, file_unique_id: str, file_type: str, expires_at: datetime = None):
+    return await storage.tokens.save_file(
+        generate_token(), user_id, file_id, file_unique_id, file_type, expires_at=expires_at
     )
 
-# Обработчик сжатых фото
-@router.message(F.content_type == "photo")
-async def handle_photo(message: types.Message):
+# Общая часть обработчиков загрузки
+async def handle_upload(message: types.Message, file_id: str, file_unique_id: str, file_type: str, saved_text: str):
+    # Элементы альбома собираются и сохраняются одним ключом
+    if message.media_group_id:
+        media_group_collector.add(message)
+        return
+
     user_id = message.from_user.id
 
     # Проверка подписки
@@ -201,181 +409,319 @@ async def handle_photo(message: types.Message):
             f"Чтобы быть в курсе новостей и получать обновления, подпишитесь на наш канал: {CHANNEL_ID}"
         )
 
-    # Берем самое большое фото
-    file_id = message.photo[-1].file_id
-
-    # Получаем информацию о фото через метод get_file
-    file_info = await bot.get_file(file_id)
-    file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
-
-    token = generate_token()
-
-    await files_collection.insert_one(
-        {
-            "token": token,
-            "file_id": file_id,
-            "file_url": file_url,
-            "user_id": user_id,
-            "uploaded_at": datetime.utcnow(),
-            "file_type": "photo",
-            "users": [],
-        }
-    )
-
-    await message.answer(
-        f"Фото сохранено. Можете поделиться им, просто отправьте этот ключ боту: `{token}`",
-        parse_mode="Markdown",
-    )
+    try:
+        expires_at = await upload_expires_at(message.caption)
+    except ValueError as e:
+        await message.answer(f"{e}. Файл не сохранен.")
+        return
+    token, created = await store_file(user_id, file_id, file_unique_id, file_type, expires_at)
 
-# Обработчик сжатых видео
-@router.message(F.content_type == "video")
-async def handle_video(message: types.Message):
-    user_id = message.from_user.id
+    if created:
+        text = f"{saved_text} Можете поделиться им, просто отправьте этот ключ боту: `{token}`"
+        text += expiry_text(expires_at)
+    else:
+        text = f"Этот файл уже сохранен. Его ключ: `{token}`"
+    await message.answer(text, parse_mode="Markdown")
+
+# Файл из сообщения в виде {file_id, file_type}
+def message_media_item(message: types.Message):
+    if message.photo:
+        return {"file_id": message.photo[-1].file_id, "file_type": "photo"}
+    if message.video:
+        return {"file_id": message.video.file_id, "file_type": "video"}
+    return {"file_id": message.document.file_id, "file_type": "document"}
+
+# Сохранение собранного альбома как одного документа-набора с одним ключом.
+# Лимит загрузок проверяется один раз на весь альбом.
+async def store_media_group(messages):
+    first_message = messages[0]
+    user_id = first_message.from_user.id
+
+    retry_after = await rate_limiter.check("upload", user_id)
+    if retry_after > 0:
+        await first_message.answer(retry_text(retry_after))
+        return
 
     # Проверка подписки
     is_subscribed = await is_user_subscribed(user_id)
     if not is_subscribed:
-        await message.answer(
+        await first_message.answer(
             f"Чтобы быть в курсе новостей и получать обновления, подпишитесь на наш канал: {CHANNEL_ID}"
         )
 
-    file_id = message.video.file_id
-
-    # Получаем информацию о видео через метод get_file
-    file_info = await bot.get_file(file_id)
-    file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
+    # Подпись альбома Telegram присылает у одного из сообщений
+    caption = next((message.caption for message in messages if message.caption), None)
+    try:
+        expires_at = await upload_expires_at(caption)
+    except ValueError as e:
+        await first_message.answer(f"{e}. Альбом не сохранен.")
+        return
 
     token = generate_token()
+    items = [message_media_item(message) for message in messages]
+    await storage.tokens.save_bundle(token, user_id, items, first_message.media_group_id, expires_at=expires_at)
 
-    await files_collection.insert_one(
-        {
-            "token": token,
-            "file_id": file_id,
-            "file_url": file_url,
-            "user_id": user_id,
-            "uploaded_at": datetime.utcnow(),
-            "file_type": "video",
-            "users": [],
-        }
-    )
-
-    await message.answer(
-        f"Видео сохранено. Можете поделиться им, просто отправьте этот ключ боту: `{token}`",
+    await first_message.answer(
+        f"Альбом из {len(items)} файлов сохранен. Можете поделиться им, просто отправьте этот ключ боту: `{token}`"
+        + expiry_text(expires_at),
         parse_mode="Markdown",
     )
 
-# Обработчик текста (обработка токена и загрузка файла)
-@router.message(F.content_type == "text")
-async def handle_text_message(message: types.Message):
-    user_id = message.from_user.id
+# Части альбома собираются в памяти процесса: при нескольких webhook-воркерах
+# альбом, разошедшийся по воркерам, сохраняется несколькими ключами
+media_group_collector = MediaGroupCollector(store_media_group, delay=MEDIA_GROUP_DELAY)
 
-    # Проверка токена
-    token = message.text.strip()
+# Обработчик загрузки файла (документ)
+@router.message(F.content_type == "document", flags={"rate_limit": "upload"})
+async def handle_file(message: types.Message):
+    document = message.document
+    await handle_upload(message, document.file_id, document.file_unique_id, "document", "Файл сохранен.")
 
-    file_doc = await files_collection.find_one({"token": token})
-    if file_doc:
-        # Проверка подписки
-        is_subscribed = await is_user_subscribed(user_id)
-        if not is_subscribed:
-            await message.answer(
-                f"Чтобы быть в курсе новостей и получать обновления, подпишитесь на наш канал: {CHANNEL_ID}"
-            )
+# Обработчик сжатых фото
+@router.message(F.content_type == "photo", flags={"rate_limit": "upload"})
+async def handle_photo(message: types.Message):
+    # Берем самое большое фото
+    photo = message.photo[-1]
+    await handle_upload(message, photo.file_id, photo.file_unique_id, "photo", "Фото сохранено.")
 
-        if user_id not in file_doc.get("users", []):
-            await files_collection.update_one(
-                {"token": token}, {"$addToSet": {"users": user_id}}
-            )
+# Обработчик сжатых видео
+@router.message(F.content_type == "video", flags={"rate_limit": "upload"})
+async def handle_video(message: types.Message):
+    video = message.video
+    await handle_upload(message, video.file_id, video.file_unique_id, "video", "Видео сохранено.")
+
+# Файлы документа в виде списка {file_id, file_type}
+def file_items(file_doc):
+    if file_doc["file_type"] == "bundle":
+        return file_doc["items"]
+    return [{"file_id": file_doc["file_id"], "file_type": file_doc["file_type"]}]
+
+async def send_single_file(chat_id: int, item):
+    if item["file_type"] == "photo":
+        await bot.send_photo(chat_id, item["file_id"])
+    elif item["file_type"] == "video":
+        await bot.send_video(chat_id, item["file_id"])
+    else:
+        await bot.send_document(chat_id, item["file_id"])
 
+# Отправка файлов по ключам: элементы всех документов объединяются
+# в группы send_media_group по 10 (документы отдельно от фото и видео)
+async def send_files(message: types.Message, file_docs):
+    items = [item for file_doc in file_docs for item in file_items(file_doc)]
+    for chunk in chunk_media(items):
         try:
-            if file_doc["file_type"] == "photo":
-                await bot.send_photo(message.chat.id, file_doc["file_id"])
-            elif file_doc["file_type"] == "video":
-                await bot.send_video(message.chat.id, file_doc["file_id"])
+            if len(chunk) == 1:
+                await send_single_file(message.chat.id, chunk[0])
             else:
-                await bot.send_document(message.chat.id, file_doc["file_id"])
-        except Exception as e:
+                await bot.send_media_group(message.chat.id, build_input_media(chunk))
+        except TelegramBadRequest as e:
+            # Только отказ Telegram принять file_id; RetryAfter и сетевые
+            # ошибки обрабатывает планировщик отправки
             logger.error(f"Ошибка при отправке файла через file_id: {e}")
+            try:
+                file_urls = [await resolve_file_url(item["file_id"]) for item in chunk]
+            except Exception as e:
+                logger.error(f"Ошибка при получении ссылки на файл: {e}")
+                await message.answer("Файл больше недоступен.")
+                continue
             await message.answer("file_id больше недоступен, отправляю файл по ссылке.")
-            await bot.send_message(message.chat.id, file_doc["file_url"])
-    else:
-        await message.answer("Файл с таким ключом не найден.")
+            await bot.send_message(message.chat.id, "\n".join(file_urls))
+
+# Полоса планировщика обновлений: загрузки и сообщения с ключами — дорогие
+def classify_update(update) -> str:
+    message = update.message
+    if message is not None:
+        if message.document or message.photo or message.video:
+            return LANE_EXPENSIVE
+        if message.text and TOKEN_SEARCH_PATTERN.search(message.text):
+            return LANE_EXPENSIVE
+    return LANE_CHEAP
+
+# Обработчик текста: один или несколько ключей в сообщении
+@router.message(F.content_type == "text", flags={"rate_limit": "redeem"})
+async def handle_text_message(message: types.Message):
+    user_id = message.from_user.id
 
-# Функция для создания индексов в базе данных
-async def create_indexes():
-    # Получаем информацию о существующих индексах в 'files_collection'
-    existing_indexes_files = await files_collection.index_information()
-
-    # Обработка индекса на поле 'token' в коллекции 'files_collection'
-    index_name = None
-    for name, info in existing_indexes_files.items():
-        keys = info.get('key')
-        if keys and keys[0][0] == 'token':
-            index_name = name
-            break
-
-    if index_name:
-        # Удаляем существующий индекс на 'token'
-        try:
-            await files_collection.drop_index(index_name)
-            logger.info(f"Существующий индекс '{index_name}' на поле 'token' был удален.")
-        except OperationFailure as e:
-            logger.error(f"Ошибка при удалении индекса '{index_name}': {e}")
-            return
+    all_tokens = find_tokens(message.text)
+    tokens = all_tokens[:REDEEM_MAX_TOKENS]
+    file_docs = await get_token_files(tokens) if tokens else {}
+    found = [token for token in tokens if file_docs.get(token)]
+    not_found = [token for token in tokens if not file_docs.get(token)]
 
-    # Создаем новый уникальный индекс на поле 'token'
-    try:
-        await files_collection.create_index('token', name='token_index', unique=True)
-        logger.info("Индекс 'token_index' в 'files_collection' создан.")
-    except OperationFailure as e:
-        logger.error(f"Ошибка при создании индекса 'token_index': {e}")
+    if not found:
+        if len(tokens) > 1:
+            await message.answer("Файлы с такими ключами не найдены.")
+        else:
+            await message.answer("Файл с таким ключом не найден.")
         return
 
-    # Аналогично для 'users_collection'
-    existing_indexes_users = await users_collection.index_information()
+    # Проверка подписки
+    is_subscribed = await is_user_subscribed(user_id)
+    if not is_subscribed:
+        await message.answer(
+            f"Чтобы быть в курсе новостей и получать обновления, подпишитесь на наш канал: {CHANNEL_ID}"
+        )
 
-    index_name = None
-    for name, info in existing_indexes_users.items():
-        keys = info.get('key')
-        if keys and keys[0][0] == 'user_id':
-            index_name = name
-            break
+    # Активации запишутся в фоне одним пакетом; повторная активация тем же
+    # пользователем счетчик не увеличивает
+    await redemption_writer.submit_many(found, user_id)
 
-    if index_name:
-        # Удаляем существующий индекс на 'user_id'
-        try:
-            await users_collection.drop_index(index_name)
-            logger.info(f"Существующий индекс '{index_name}' на поле 'user_id' был удален.")
-        except OperationFailure as e:
-            logger.error(f"Ошибка при удалении индекса '{index_name}': {e}")
-            return
+    await send_files(message, [file_docs[token] for token in found])
 
-    # Создаем новый уникальный индекс на поле 'user_id' в 'users_collection'
-    try:
-        await users_collection.create_index('user_id', name='user_id_index', unique=True)
-        logger.info("Индекс 'user_id_index' в 'users_collection' создан.")
-    except OperationFailure as e:
-        logger.error(f"Ошибка при создании индекса 'user_id_index': {e}")
-        return
+    # Один ответ про все ненайденные и пропущенные ключи
+    notes = []
+    if not_found:
+        notes.append("Не найдены ключи:\n" + "\n".join(f"`{token}`" for token in not_found))
+    if len(all_tokens) > len(tokens):
+        notes.append(f"Обработаны первые {len(tokens)} ключей, остальные отправьте отдельным сообщением.")
+    if notes:
+        await message.answer("\n\n".join(notes), parse_mode="Markdown")
 
-    # Создаем индексы на 'user_id', 'uploaded_at' в 'files_collection'
-    try:
-        await files_collection.create_index('user_id', name='files_user_id_index')
-        logger.info("Индекс 'files_user_id_index' в 'files_collection' создан.")
-    except OperationFailure as e:
-        logger.error(f"Ошибка при создании индекса 'files_user_id_index': {e}")
+# Функция для создания индексов (или схемы SQLite): создается только то,
+# чего не хватает, существующие индексы не перестраиваются
+async def create_indexes():
+    started = time.perf_counter()
+    await storage.prepare()
+    if isinstance(rate_limit_backend, MongoBackend):
+        await rate_limit_backend.ensure_indexes()
+    if isinstance(fsm_storage, MongoStorage):
+        await fsm_storage.ensure_indexes()
+    logger.info(f"Проверка индексов заняла {time.perf_counter() - started:.3f} с.")
+
+# Подключение к базе, хранилище, бот и диспетчер. Клиент MongoDB и пул
+# HTTP-соединений общие для всех ботов процесса (см. clients.py).
+def create_clients():
+    global client, db, storage, redemption_writer, bot, send_scheduler, fsm_storage, dp, update_scheduler
+    global rate_limit_backend, rate_limiter
+
+    client = get_mongo_client()
+    db = client[MONGO_DB]
+    storage = create_storage(STORAGE_BACKEND, db, sqlite_path=SQLITE_PATH)
+
+    # Очередь активаций, которая пишется в базу пакетами в фоне
+    redemption_writer = RedemptionWriter(
+        storage.tokens,
+        batch_size=REDEMPTION_BATCH_SIZE,
+        flush_interval=REDEMPTION_FLUSH_INTERVAL,
+        max_queue=REDEMPTION_QUEUE_SIZE,
+    )
 
-    try:
-        await files_collection.create_index('uploaded_at', name='uploaded_at_index')
-        logger.info("Индекс 'uploaded_at_index' в 'files_collection' создан.")
-    except OperationFailure as e:
-        logger.error(f"Ошибка при создании индекса 'uploaded_at_index': {e}")
+    bot = Bot(token=TOKEN, session=create_bot_session())
+    # Все отправки идут через планировщик: файлы по ключам раньше остальных сообщений
+    send_scheduler = SendScheduler(global_rate=SEND_GLOBAL_RATE, max_retries=SEND_MAX_RETRIES)
+    bot.session.middleware(send_scheduler)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    fsm_storage = create_fsm_storage(FSM_STORAGE, db, state_ttl=FSM_STATE_TTL, cache_ttl=FSM_CACHE_TTL)
+
+    # Планировщик обновлений стоит перед FSM: следующее обновление
+    # пользователя читает состояние только после завершения предыдущего
+    dp = Dispatcher(storage=fsm_storage, disable_fsm=True)
+    # Профиль обновления заводится первым, чтобы учесть и ожидание в очереди
+    if SLOW_UPDATE_SECONDS:
+        slow_updates = SlowUpdateMiddleware(SLOW_UPDATE_SECONDS)
+        dp.update.outer_middleware(slow_updates)
+        REGISTRY.register_stats("slow_updates", slow_updates.stats)
+    update_scheduler = UpdateScheduler(
+        classify=classify_update,
+        max_concurrency=UPDATE_MAX_CONCURRENCY,
+        expensive_concurrency=UPDATE_EXPENSIVE_CONCURRENCY,
+        max_queue=UPDATE_MAX_QUEUE,
+        max_user_queue=UPDATE_MAX_USER_QUEUE,
+        shed_text="Бот сейчас перегружен, повторите запрос через минуту.",
+    )
+    dp.update.outer_middleware(update_scheduler)
+    dp.update.outer_middleware(dp.fsm)
 
-# Запуск бота
-async def main():
+    # Ограничение количества запросов от пользователя
+    if RATE_LIMIT_BACKEND == "mongo":
+        rate_limit_backend = MongoBackend(db["rate_limits"])
+    else:
+        rate_limit_backend = MemoryBackend(maxsize=RATE_LIMIT_MEMORY_SIZE)
+    rate_limiter = RateLimiter(
+        rate_limit_backend,
+        {action: parse_policy(spec) for action, spec in RATE_LIMITS.items()},
+    )
+    router.message.middleware(RateLimitMiddleware(rate_limiter))
+    router.callback_query.middleware(RateLimitMiddleware(rate_limiter))
+
+    # Статистика кэшей и очередей в метриках
+    REGISTRY.register_stats("token_cache", token_cache.stats)
+    REGISTRY.register_stats("subscription_cache", subscription_cache.stats)
+    REGISTRY.register_stats("file_url_cache", file_url_cache.stats)
+    REGISTRY.register_stats("redemption_writer", redemption_writer.stats)
+    REGISTRY.register_stats("send_scheduler", send_scheduler.stats)
+    REGISTRY.register_stats("update_scheduler", update_scheduler.stats)
+
+# Фоновые задачи процесса
+background_tasks = []
+metrics_runner = None
+
+# Запуск бота (общий для polling и webhook)
+async def on_startup():
+    global metrics_runner
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, profile_token=PROFILE_TOKEN)
     await create_indexes()  # Создаем индексы в базе данных
+    if isinstance(storage.tokens, MongoTokenStore):
+        await migrate_users_arrays_once(db, storage.settings)  # Переносим старые массивы users в 'redemptions'
+    # Сбрасываем из кэша токены, удаленные через админский бот
+    background_tasks.append(
+        asyncio.create_task(storage.tokens.watch_invalidations(invalidate_tokens))
+    )
+    # Удаляем истекшие ключи и переносим старые активации в архив
+    background_tasks.append(
+        asyncio.create_task(
+            run_compaction(
+                storage,
+                get_retention_policy,
+                on_tokens_expired,
+                interval=COMPACTION_INTERVAL,
+                batch_size=COMPACTION_BATCH_SIZE,
+            )
+        )
+    )
+    redemption_writer.start()
+
+# Остановка бота: дописываем накопленные активации
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await media_group_collector.close()
+    await redemption_writer.stop()
+    logger.info(f"Очередь активаций сброшена: {redemption_writer.stats()}")
+    await send_scheduler.close()
+    await storage.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+def setup_dispatcher():
+    create_clients()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    instrument_dispatcher(dp, [router])
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+
+# Настройки, при которых состояние бота живет в памяти процесса
+# и не делится между webhook-воркерами
+def process_local_settings() -> list:
+    return [
+        f"{name}={value}"
+        for name, value in (("FSM_STORAGE", FSM_STORAGE), ("RATE_LIMIT_BACKEND", RATE_LIMIT_BACKEND))
+        if value != "mongo"
+    ]
+
+# Запуск бота в режиме polling
+async def main():
+    setup_dispatcher()
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook("user_bot", "USER_", process_local_settings())
+    else:
+        asyncio.run(main())
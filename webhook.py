@@ -0,0 +1,116 @@
+import os
+import asyncio
+import importlib
+import logging
+import multiprocessing
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from clients import close_clients
+
+logger = logging.getLogger(__name__)
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Настройки webhook для конкретного бота; prefix — "USER_" или "ADMIN_"
+class WebhookConfig:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.base_url = os.getenv(f"{prefix}WEBHOOK_URL")  # Публичный адрес, например https://example.com
+        self.path = os.getenv(f"{prefix}WEBHOOK_PATH", "/webhook")
+        self.host = os.getenv(f"{prefix}WEBHOOK_HOST", "0.0.0.0")
+        self.port = int(os.getenv(f"{prefix}WEBHOOK_PORT", "8080"))
+        self.secret = os.getenv(f"{prefix}WEBHOOK_SECRET")
+        self.workers = int(os.getenv(f"{prefix}WEBHOOK_WORKERS", "1"))
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url.rstrip('/')}{self.path}"
+
+# aiohttp-приложение, принимающее обновления и проверяющее секретный заголовок
+def build_webhook_app(dp, bot, config: WebhookConfig) -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=config.secret).register(
+        app, path=config.path
+    )
+    # Запускает dp.startup/dp.shutdown вместе с приложением
+    setup_application(app, dp, bot=bot)
+    return app
+
+# close_shared=False — общие клиенты закроет вызывающий (launcher.py)
+async def serve_webhook(dp, bot, config: WebhookConfig, set_webhook: bool = True, close_shared: bool = True):
+    if set_webhook:
+        if not config.base_url:
+            raise RuntimeError(f"Не задан {config.prefix}WEBHOOK_URL для режима webhook")
+        await bot.set_webhook(
+            config.url,
+            secret_token=config.secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+        logger.info(f"Webhook установлен: {config.url}")
+
+    runner = web.AppRunner(build_webhook_app(dp, bot, config))
+    await runner.setup()
+    # reuse_port позволяет нескольким процессам слушать один порт
+    site = web.TCPSite(runner, config.host, config.port, reuse_port=config.workers > 1)
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {config.host}:{config.port}{config.path} (pid {os.getpid()})")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        if close_shared:
+            await close_clients()
+
+# Процесс-воркер: модуль бота импортируется заново, поэтому у каждого
+# воркера свои Bot, Dispatcher и подключение к MongoDB
+def _webhook_worker(module_name: str, prefix: str, index: int):
+    module = importlib.import_module(module_name)
+    module.setup_dispatcher()
+    config = WebhookConfig(prefix)
+    try:
+        # Webhook в Telegram регистрирует только первый воркер
+        asyncio.run(serve_webhook(module.dp, module.bot, config, set_webhook=index == 0))
+    except KeyboardInterrupt:
+        pass
+
+# Запуск бота в режиме webhook с {prefix}WEBHOOK_WORKERS процессами.
+#
+# Telegram раскладывает обновления по воркерам произвольно, поэтому
+# состояние, которое должно быть общим, обязано лежать в MongoDB:
+# process_local — настройки бота, при которых оно хранится в памяти
+# процесса (например, "FSM_STORAGE=memory"); с ними несколько воркеров
+# не запускаются.
+#
+# Остается в памяти каждого воркера всегда:
+# - сборка альбомов (MediaGroupCollector): части одного альбома, попавшие
+#   в разные воркеры, сохраняются отдельными ключами;
+# - порядок обновлений одного пользователя (UpdateScheduler) соблюдается
+#   только внутри воркера.
+def run_webhook(module_name: str, prefix: str, process_local: list = ()):
+    config = WebhookConfig(prefix)
+    if config.workers <= 1:
+        _webhook_worker(module_name, prefix, 0)
+        return
+    if process_local:
+        raise RuntimeError(
+            f"{prefix}WEBHOOK_WORKERS={config.workers} требует общего состояния в MongoDB, "
+            f"а сейчас в памяти процесса: {', '.join(process_local)}"
+        )
+
+    # spawn, а не fork: клиент MongoDB нельзя переносить в дочерний процесс
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_webhook_worker, args=(module_name, prefix, index), daemon=False)
+        for index in range(config.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()